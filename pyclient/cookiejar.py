@@ -18,16 +18,24 @@
 Command line interface for cookiejar TF.
 Parses command line arguments and passes to the CookieJarClient class
 to process.
+
+bake, eat, count and clear are forwarded to a running `cookiejar.py
+serve` daemon when there is one, and run in this process otherwise.  The
+client modules are imported only when needed, so forwarding a command
+costs little more than starting Python.
 '''
 
 import argparse
+import json
 import logging
 import os
 import sys
 import traceback
 
-from colorlog import ColoredFormatter
-from cookiejar_client import CookieJarClient
+from cookiejar_daemon import DEFAULT_SOCKET
+from cookiejar_daemon import Daemon
+from cookiejar_daemon import DaemonUnavailable
+from cookiejar_daemon import request
 
 KEY_NAME = 'mycookiejar'
 
@@ -36,9 +44,18 @@ KEY_NAME = 'mycookiejar'
 # For Docker:
 DEFAULT_URL = 'http://rest-api:8008'
 
+# Commands a daemon can run for the CLI.
+DAEMON_COMMANDS = ('bake', 'eat', 'count', 'clear')
+
+FAMILY_VERSIONS = ('1.0', '1.1')
+# The default of --family-version.  Set it to 1.0 where the transaction
+# processor is the C++ or Java one, which only support version 1.0.
+FAMILY_VERSION_ENV = 'COOKIEJAR_FAMILY_VERSION'
+
 def create_console_handler(verbose_level):
     '''Setup console logging.'''
     del verbose_level # unused
+    from colorlog import ColoredFormatter
     clog = logging.StreamHandler()
     formatter = ColoredFormatter(
         "%(log_color)s[%(asctime)s %(levelname)-8s%(module)s]%(reset)s "
@@ -63,13 +80,43 @@ def setup_loggers(verbose_level):
     logger.setLevel(logging.DEBUG)
     logger.addHandler(create_console_handler(verbose_level))
 
+def _create_common_parser(prog_name, with_defaults):
+    '''Create a parent parser of the options accepted both before and
+       after the subcommand.
+
+       The subcommands' copy is created without defaults, so an option
+       given before the subcommand is not overwritten by its default.
+    '''
+    def default(value):
+        return value if with_defaults else argparse.SUPPRESS
+
+    parent_parser = argparse.ArgumentParser(prog=prog_name, add_help=False)
+    parent_parser.add_argument('--jar', default=default(''),
+                               help='name of the cookie jar to use '
+                               '(default: the unnamed jar)')
+    parent_parser.add_argument('--socket', default=default(DEFAULT_SOCKET),
+                               help='Unix socket of the cookiejar daemon '
+                               '(default {})'.format(DEFAULT_SOCKET))
+    parent_parser.add_argument('--no-daemon', action='store_true',
+                               default=default(False),
+                               help='run the command in this process even '
+                               'if a daemon is running')
+    parent_parser.add_argument('--family-version', choices=FAMILY_VERSIONS,
+                               default=default(
+                                   os.environ.get(FAMILY_VERSION_ENV)),
+                               help='transaction family version to send; '
+                               '1.0 for the C++ and Java processors '
+                               '(default: ${} or 1.1)'.format(
+                                   FAMILY_VERSION_ENV))
+    return parent_parser
+
 def create_parser(prog_name):
     '''Create the command line argument parser for the cookiejar CLI.'''
-    parent_parser = argparse.ArgumentParser(prog=prog_name, add_help=False)
+    parent_parser = _create_common_parser(prog_name, with_defaults=False)
 
     parser = argparse.ArgumentParser(
         description='Provides subcommands to manage your simple cookie baker',
-        parents=[parent_parser])
+        parents=[_create_common_parser(prog_name, with_defaults=True)])
 
     subparsers = parser.add_subparsers(title='subcommands', dest='command')
     subparsers.required = True
@@ -94,7 +141,62 @@ def create_parser(prog_name):
     clear_subparser = subparsers.add_parser('clear',
                                            help='empties cookie jar',
                                            parents=[parent_parser])					  
-						  
+
+    generate_subparser = subparsers.add_parser(
+        'generate',
+        help='sign transactions into a batch file to submit later',
+        parents=[parent_parser])
+    generate_subparser.add_argument('file',
+                                    help='batch file to write')
+    generate_subparser.add_argument('--action', default='bake',
+                                    choices=['bake', 'eat', 'clear'],
+                                    help='action of every transaction '
+                                    '(default %(default)s)')
+    generate_subparser.add_argument('--amount', type=int, default=1,
+                                    help='cookies per transaction '
+                                    '(default %(default)s)')
+    generate_subparser.add_argument('--transactions', type=int,
+                                    default=1000,
+                                    help='transactions to sign '
+                                    '(default %(default)s)')
+    generate_subparser.add_argument('--batches-per-list', type=int,
+                                    help='batches per BatchList, the unit '
+                                    'submit sends (default: as many as the '
+                                    'BatchList limits allow)')
+    generate_subparser.add_argument('--workers', type=int,
+                                    help='signing processes (default: one '
+                                    'per CPU)')
+
+    submit_subparser = subparsers.add_parser(
+        'submit',
+        help='send the batches in a batch file to the REST API',
+        parents=[parent_parser])
+    submit_subparser.add_argument('file',
+                                  help='batch file written by generate')
+    submit_subparser.add_argument('--rate', type=float,
+                                  help='BatchLists to send per second '
+                                  '(default: as fast as accepted)')
+
+    bulk_subparser = subparsers.add_parser(
+        'bulk',
+        help='apply JSON lines of operations, printing one result each',
+        parents=[parent_parser])
+    bulk_subparser.add_argument('file', nargs='?', default='-',
+                                help='JSON lines of operations, such as '
+                                '{"action": "bake", "amount": 5}; '
+                                'default standard input')
+    bulk_subparser.add_argument('--max-in-flight', type=int,
+                                help='operations outstanding at once '
+                                '(default 32)')
+    bulk_subparser.add_argument('--wait', type=float,
+                                help='seconds each operation waits to '
+                                'commit; 0 only submits (default 10)')
+
+    subparsers.add_parser('serve',
+                          help='run a daemon that keeps the client warm '
+                          'and runs bake, eat, count and clear for the CLI',
+                          parents=[parent_parser])
+
     return parser
 
 def _get_private_keyfile(key_name):
@@ -103,36 +205,138 @@ def _get_private_keyfile(key_name):
     key_dir = os.path.join(home, ".sawtooth", "keys")
     return '{}/{}.priv'.format(key_dir, key_name)
 
+def _get_client(jar='', family_version=None):
+    '''Get the long-lived client for KEY_NAME and the named jar.'''
+    from cookiejar_client import FAMILY_VERSION
+    from cookiejar_client import get_client
+    return get_client(DEFAULT_URL, _get_private_keyfile(KEY_NAME), jar,
+                      family_version or FAMILY_VERSION)
+
+def run_command(command_request):
+    '''Run a bake, eat, count or clear request and return its output.
+
+       The request is a dictionary with the "command", its "amount", the
+       "jar" and the "family_version".  Used in process and by the daemon.
+    '''
+    command = command_request.get('command')
+    if command not in DAEMON_COMMANDS:
+        raise Exception("Invalid command: {}".format(command))
+    family_version = command_request.get('family_version')
+    if family_version not in (None,) + FAMILY_VERSIONS:
+        raise Exception("Invalid family version: {}".format(family_version))
+    client = _get_client(command_request.get('jar', ''), family_version)
+    if command == 'bake':
+        response = client.bake(command_request['amount'])
+        return "Bake Response: {}".format(response)
+    if command == 'eat':
+        response = client.eat(command_request['amount'])
+        return "Eat Response: {}".format(response)
+    if command == 'count':
+        data = client.count()
+        if data is None:
+            raise Exception("Cookie jar data not found")
+        return "\nThe cookie jar has {} cookies.\n".format(data)
+    response = client.clear()
+    return "Clear Response: {}".format(response)
+
+def _run(args, command, amount=None):
+    '''Run a command through the daemon if one is running, else here.'''
+    command_request = {'command': command, 'amount': amount, 'jar': args.jar,
+                       'family_version': args.family_version}
+    if not args.no_daemon:
+        try:
+            return request(args.socket, command_request)
+        except DaemonUnavailable:
+            pass
+    setup_loggers(verbose_level=0)
+    return run_command(command_request)
+
 def do_bake(args):
     '''Subcommand to bake cookies.  Calls client class to do the baking.'''
-    privkeyfile = _get_private_keyfile(KEY_NAME)
-    client = CookieJarClient(base_url=DEFAULT_URL, key_file=privkeyfile)
-    response = client.bake(args.amount)
-    print("Bake Response: {}".format(response))
+    print(_run(args, 'bake', args.amount))
 
 def do_eat(args):
     '''Subcommand to eat cookies.  Calls client class to do the eating.'''
-    privkeyfile = _get_private_keyfile(KEY_NAME)
-    client = CookieJarClient(base_url=DEFAULT_URL, key_file=privkeyfile)
-    response = client.eat(args.amount)
-    print("Eat Response: {}".format(response))
+    print(_run(args, 'eat', args.amount))
 
-def do_count():
+def do_count(args):
     '''Subcommand to count cookies.  Calls client class to do the counting.'''
-    privkeyfile = _get_private_keyfile(KEY_NAME)
-    client = CookieJarClient(base_url=DEFAULT_URL, key_file=privkeyfile)
-    data = client.count()
-    if data is not None:
-        print("\nThe cookie jar has {} cookies.\n".format(data.decode()))
-    else:
-        raise Exception("Cookie jar data not found")
+    print(_run(args, 'count'))
 		
-def do_clear():
+def do_clear(args):
     '''Subcommand to empty cookie jar. Calls client class to do the clearing.'''
-    privkeyfile = _get_private_keyfile(KEY_NAME)
-    client = CookieJarClient(base_url=DEFAULT_URL, key_file=privkeyfile)
-    response = client.clear()
-    print("Clear Response: {}".format(response))
+    print(_run(args, 'clear'))
+
+def do_serve(args):
+    '''Subcommand to serve CLI requests with a warm client until
+       interrupted or sent SIGTERM.
+    '''
+    import signal
+    # Load the key and open the connection pool before taking requests.
+    _get_client(args.jar, args.family_version)
+    daemon = Daemon(run_command, args.socket)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    logging.getLogger(__name__).info('Serving on %s', args.socket)
+    daemon.serve_forever()
+
+def do_generate(args):
+    '''Subcommand to sign transactions into a batch file.'''
+    from cookiejar_batch_file import write_batch_lists
+    from cookiejar_client import FAMILY_VERSION
+    from cookiejar_client import MAX_BATCHES_PER_BATCH_LIST
+    from cookiejar_pipeline import SigningPipeline
+    operations = ((args.action, args.amount)
+                  for _ in range(args.transactions))
+    with SigningPipeline.from_key_file(_get_private_keyfile(KEY_NAME),
+                                       workers=args.workers,
+                                       jar=args.jar,
+                                       family_version=args.family_version or
+                                       FAMILY_VERSION) as pipeline:
+        batch_lists, batches, size = write_batch_lists(
+            args.file, pipeline.batch_lists(
+                operations, batches_per_list=args.batches_per_list or
+                MAX_BATCHES_PER_BATCH_LIST))
+    print("Wrote {} transactions in {} batches ({} BatchLists, {} bytes) "
+          "to {}".format(args.transactions, batches, batch_lists, size,
+                         args.file))
+
+def do_submit(args):
+    '''Subcommand to send a batch file to the REST API.'''
+    from cookiejar_batch_file import submit_file
+    from cookiejar_client import CookieJarClient
+    client = CookieJarClient(DEFAULT_URL)
+    try:
+        report = submit_file(client, args.file, args.rate)
+    finally:
+        client.close()
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+def do_bulk(args):
+    '''Subcommand to apply a stream of operations in one process.'''
+    from cookiejar_bulk import BulkRunner
+    from cookiejar_bulk import DEFAULT_MAX_IN_FLIGHT
+    from cookiejar_bulk import DEFAULT_WAIT
+    from cookiejar_bulk import SUCCESS_STATUSES
+    from cookiejar_client import FAMILY_VERSION
+    lines = sys.stdin if args.file == '-' else open(args.file)
+    failed = 0
+    try:
+        with BulkRunner(DEFAULT_URL, _get_private_keyfile(KEY_NAME),
+                        DEFAULT_MAX_IN_FLIGHT if args.max_in_flight is None
+                        else args.max_in_flight,
+                        DEFAULT_WAIT if args.wait is None else args.wait,
+                        args.family_version or FAMILY_VERSION) as runner:
+            for result in runner.run(lines):
+                if 'error' in result or \
+                        result.get('status', 'COMMITTED') \
+                        not in SUCCESS_STATUSES:
+                    failed += 1
+                print(json.dumps(result, sort_keys=True), flush=True)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    if failed:
+        sys.exit(1)
 
 def main(prog_name=os.path.basename(sys.argv[0]), args=None):
     '''Entry point function for the client CLI.'''
@@ -141,8 +345,13 @@ def main(prog_name=os.path.basename(sys.argv[0]), args=None):
             args = sys.argv[1:]
         parser = create_parser(prog_name)
         args = parser.parse_args(args)
+        if args.family_version not in (None,) + FAMILY_VERSIONS:
+            parser.error('${} must be one of {}'.format(
+                FAMILY_VERSION_ENV, ', '.join(FAMILY_VERSIONS)))
         verbose_level = 0
-        setup_loggers(verbose_level=verbose_level)
+        # Commands the daemon may run set up logging only if run here.
+        if args.command not in DAEMON_COMMANDS:
+            setup_loggers(verbose_level=verbose_level)
 
         # Get the commands from cli args and call corresponding handlers
         if args.command == 'bake':
@@ -150,9 +359,17 @@ def main(prog_name=os.path.basename(sys.argv[0]), args=None):
         elif args.command == 'eat':
             do_eat(args)
         elif args.command == 'count':
-            do_count()
+            do_count(args)
         elif args.command == 'clear':
-            do_clear()	
+            do_clear(args)	
+        elif args.command == 'generate':
+            do_generate(args)
+        elif args.command == 'submit':
+            do_submit(args)
+        elif args.command == 'bulk':
+            do_bulk(args)
+        elif args.command == 'serve':
+            do_serve(args)
         else:
             raise Exception("Invalid command: {}".format(args.command))
 
@@ -0,0 +1,314 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+AsyncCookieJarClient class interfaces with Sawtooth through the REST API
+using asyncio, so one process can keep many submissions in flight.
+'''
+
+import asyncio
+import base64
+import collections
+import json
+
+from urllib.parse import urlparse
+
+import aiohttp
+
+from sawtooth_sdk.protobuf.batch_pb2 import BatchList
+
+from cookiejar_client import CookieJarClient
+from cookiejar_client import DEFAULT_BACKOFF_FACTOR
+from cookiejar_client import DEFAULT_POOL_SIZE
+from cookiejar_client import DEFAULT_RETRIES
+from cookiejar_client import DEFAULT_TIMEOUT
+from cookiejar_client import NAMESPACE
+from cookiejar_client import RETRY_STATUS_CODES
+from cookiejar_client import RestApiError
+from cookiejar_client import STATE_PAGE_SIZE
+from cookiejar_client import STATUS_IDS_PER_REQUEST
+from cookiejar_client import cookiejar_address
+from cookiejar_client import decode_count
+
+
+class AsyncCookieJarClient(CookieJarClient):
+    '''Asyncio Client Cookie Jar class
+
+    Supports the same "bake", "eat", "count" and "clear" functions as
+    CookieJarClient, as coroutines, along with the bulk and named-jar
+    functions.  Transactions and batches are built by CookieJarClient, so
+    both clients produce identical bytes.
+    Must be created and used inside a running event loop.
+    '''
+
+    def __init__(self, base_url, key_file=None, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, metrics=None):
+        '''Initialize the client class.
+
+           'pool_size' bounds the number of simultaneous connections to the
+           REST API; further requests queue until a connection is free.
+           'metrics', a ClientMetrics, times each phase of a submission.
+        '''
+        super().__init__(base_url, key_file, timeout=timeout,
+                         metrics=metrics)
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+        self._http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size))
+
+    async def bake(self, amount):
+        '''Bake amount cookies for the cookie jar.'''
+        return await self._wrap_and_send("bake", amount, wait=10)
+
+    async def eat(self, amount):
+        '''Eat amount cookies from the cookie jar.'''
+        try:
+            ret_amount = await self._wrap_and_send("eat", amount, wait=10)
+        except Exception:
+            raise Exception('Encountered an error during eat')
+        return ret_amount
+
+    async def count(self):
+        '''Count the number of cookies in the cookie jar.'''
+        return await self._get_count(self._address)
+
+    async def count_jars(self, jars):
+        '''Return a dictionary of jar name to count, or None for jars
+           that do not exist.
+        '''
+        jars = list(jars)
+        counts = await asyncio.gather(
+            *[self._get_count(cookiejar_address(self._public_key, 0, jar))
+              for jar in jars])
+        return dict(zip(jars, counts))
+
+    async def apply_jar_operations(self, jar_operations, wait=10):
+        '''Apply operations to several named jars in bulk; see
+           CookieJarClient.apply_jar_operations().
+        '''
+        builder = self.new_batch_builder()
+        for jar, operations in dict(jar_operations).items():
+            builder.add_operations(operations, jar=jar)
+        return await self.submit_batch_lists(builder.batch_lists(), wait)
+
+    async def bake_jars(self, amounts, wait=10):
+        '''Bake amounts[name] cookies in each named jar.'''
+        return await self.apply_jar_operations(
+            {jar: [("bake", amount)] for jar, amount in amounts.items()},
+            wait)
+
+    async def clear_jars(self, jars, wait=10):
+        '''Empty each of the named jars.'''
+        return await self.apply_jar_operations(
+            {jar: [("clear", 0)] for jar in jars}, wait)
+
+    async def apply_operations(self, operations):
+        '''Apply a list of (action, amount) pairs as one transaction;
+           see CookieJarClient.apply_operations().
+        '''
+        transaction = self._create_operations_transaction(operations)
+        batch_list = BatchList(batches=[self._create_batch([transaction])])
+        return await self._send_batch_list(batch_list, wait=10)
+
+    def iter_counts(self, address_prefix=NAMESPACE,
+                    page_size=STATE_PAGE_SIZE):
+        '''Return an asynchronous iterator of (address, count) for every
+           cookie jar in the namespace, for use with "async for".
+
+           Pages are read as in CookieJarClient.iter_counts(), one at a
+           time, from one consistent snapshot.
+        '''
+        return _StateCounts(self, "state?address={}&limit={}".format(
+            address_prefix, page_size))
+
+    async def _get_count(self, address):
+        '''Return the count stored at address, or None if there is none.'''
+        try:
+            result = await self._send_to_rest_api(
+                "state/{}".format(address))
+        except RestApiError as err:
+            if err.status_code == 404:
+                return None
+            raise
+        return decode_count(base64.b64decode(json.loads(result)["data"]))
+
+    async def clear(self):
+        '''Empty the cookie jar.'''
+        try:
+            ret_amount = await self._wrap_and_send("clear", 0, wait=10)
+        except Exception:
+            raise Exception('Encountered an error during clear')
+        return ret_amount
+
+    async def submit(self, action, amount):
+        '''Send one bake/eat/clear action without waiting for it to commit.
+
+           Returns the batch ID, to be passed to wait_for_batch().
+        '''
+        batch_list = BatchList(batches=[
+            self._create_batch([self._create_transaction(action, amount)])])
+        await self._send_to_rest_api("batches",
+                                     batch_list.SerializeToString(),
+                                     'application/octet-stream')
+        return batch_list.batches[0].header_signature
+
+    async def wait_for_batch(self, batch_id, wait=10):
+        '''Wait up to 'wait' seconds for a batch to leave PENDING.'''
+        return await self._wait_for_status(batch_id, wait, None)
+
+    async def close(self):
+        '''Close the REST API connections.'''
+        await self._http.close()
+        super().close()
+
+    async def _send_to_rest_api(self, suffix, data=None, content_type=None,
+                                wait=0):
+        '''Send a REST command to the Validator via the REST API.
+
+           Requests answered with 429 or 503 are retried with exponential
+           backoff, as the synchronous client does.
+        '''
+        url = "{}/{}".format(self._base_url, suffix)
+
+        headers = {}
+
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+
+        attempt = 0
+        while True:
+            try:
+                status, reason, text = await asyncio.wait_for(
+                    self._request(url, headers, data),
+                    self._timeout + wait)
+            except aiohttp.ClientConnectionError as err:
+                if attempt >= self._retries:
+                    raise Exception(
+                        'Failed to connect to {}: {}'.format(url, str(err)))
+            except asyncio.TimeoutError:
+                raise Exception('Timed out waiting for {}'.format(url))
+            else:
+                if status not in RETRY_STATUS_CODES or \
+                        attempt >= self._retries:
+                    break
+            await asyncio.sleep(self._backoff_factor * (2 ** attempt))
+            attempt += 1
+
+        if not 200 <= status < 300:
+            raise RestApiError(status, reason)
+        return text
+
+    async def _request(self, url, headers, data):
+        if data is not None:
+            request = self._http.post(url, headers=headers, data=data)
+        else:
+            request = self._http.get(url, headers=headers)
+        async with request as response:
+            return response.status, response.reason, await response.text()
+
+    async def _wait_for_status(self, batch_id, wait, result):
+        '''Wait until transaction status is not PENDING (COMMITTED or error).
+
+           The REST API holds each request open for up to 'wait' seconds,
+           so waiting does not block the event loop or poll in a busy loop.
+        '''
+        if wait and wait > 0:
+            loop = asyncio.get_event_loop()
+            deadline = loop.time() + wait
+            while loop.time() < deadline:
+                result = await self._send_to_rest_api(
+                    "batch_statuses?id={}&wait={}".format(batch_id, wait),
+                    wait=wait)
+                statuses = [batch_status['status'] for batch_status
+                            in json.loads(result)['data']]
+
+                if 'PENDING' not in statuses:
+                    return result
+            return "Transaction timed out after waiting {} seconds." \
+               .format(wait)
+        else:
+            return result
+
+    async def _send_batch_list(self, batch_list, wait=None):
+        '''Send a BatchList to the REST API and optionally wait for it.'''
+        batch_ids = [batch.header_signature for batch in batch_list.batches]
+
+        with self._span('submit', batch_ids=batch_ids):
+            result = await self._send_to_rest_api(
+                "batches", batch_list.SerializeToString(),
+                'application/octet-stream')
+        return await self._wait_for_batches(batch_ids, wait, result)
+
+    async def _wait_for_batches(self, batch_ids, wait, result):
+        '''Wait until none of batch_ids is PENDING, through the status
+           tracker if one is attached.
+        '''
+        if not wait or wait <= 0:
+            return result
+        with self._span('commit', batch_ids=batch_ids):
+            if self._status_tracker is not None:
+                statuses = await asyncio.gather(
+                    *[asyncio.wrap_future(
+                        self._status_tracker.track(batch_id, timeout=wait))
+                      for batch_id in batch_ids])
+                if any(status['status'] == 'PENDING' for status in statuses):
+                    return "Transaction timed out after waiting {} " \
+                        "seconds.".format(wait)
+                return json.dumps({'data': statuses})
+            for start in range(0, len(batch_ids), STATUS_IDS_PER_REQUEST):
+                result = await self._wait_for_status(
+                    ",".join(batch_ids[start:start + STATUS_IDS_PER_REQUEST]),
+                    wait, result)
+            return result
+
+    async def _wrap_and_send(self, action, amount, wait=None):
+        '''Create a transaction, wrap it in a batch and send it.'''
+        transaction = self._create_transaction(action, amount)
+        batch = self._create_batch([transaction])
+        return await self._send_batch_list(BatchList(batches=[batch]), wait)
+
+    async def submit_batch_lists(self, batch_lists, wait=None):
+        '''Send BatchLists, e.g. from CookieJarBatchBuilder.batch_lists(),
+           concurrently and return their results in order.
+        '''
+        return await asyncio.gather(
+            *[self._send_batch_list(batch_list, wait)
+              for batch_list in batch_lists])
+
+
+class _StateCounts(object):
+    '''Asynchronous iterator over the pages of GET /state.'''
+
+    def __init__(self, client, suffix):
+        self._client = client
+        self._suffix = suffix
+        self._entries = collections.deque()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._entries:
+            if self._suffix is None:
+                raise StopAsyncIteration
+            page = json.loads(await self._client._send_to_rest_api(
+                self._suffix))
+            self._entries.extend(page['data'])
+            next_url = page.get('paging', {}).get('next')
+            self._suffix = "state?{}".format(urlparse(next_url).query) \
+                if next_url else None
+        entry = self._entries.popleft()
+        return entry['address'], \
+            decode_count(base64.b64decode(entry['data']))
@@ -0,0 +1,110 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+Batch files hold signed BatchLists ahead of time, so load can be generated
+on one host and replayed from another at the cost of I/O alone.
+
+A batch file is a sequence of records, each a 4-byte big-endian length
+followed by that many bytes of a serialized BatchList.
+'''
+
+import mmap
+import os
+import struct
+import time
+
+LENGTH_FORMAT = struct.Struct('>I')
+
+
+def write_batch_lists(path, batch_lists):
+    '''Write BatchLists to a batch file at path as they are produced.
+
+       'batch_lists' may be a generator, such as
+       SigningPipeline.batch_lists(), so the file can be far larger than
+       memory.  The file is written under a temporary name and renamed
+       when complete.  Returns (BatchLists, batches, bytes) written.
+    '''
+    temp_path = '{}.tmp'.format(path)
+    batch_list_count = 0
+    batch_count = 0
+    try:
+        with open(temp_path, 'wb') as batch_file:
+            for batch_list in batch_lists:
+                data = batch_list.SerializeToString()
+                batch_file.write(LENGTH_FORMAT.pack(len(data)))
+                batch_file.write(data)
+                batch_list_count += 1
+                batch_count += len(batch_list.batches)
+            size = batch_file.tell()
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+    return batch_list_count, batch_count, size
+
+
+def iter_records(path):
+    '''Yield each serialized BatchList in a batch file, as bytes.
+
+       The file is memory-mapped, so only the records being sent are
+       paged in.
+    '''
+    with open(path, 'rb') as batch_file:
+        if os.fstat(batch_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(batch_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset < len(data):
+                if len(data) - offset < LENGTH_FORMAT.size:
+                    raise Exception('Truncated batch file {}'.format(path))
+                length, = LENGTH_FORMAT.unpack_from(data, offset)
+                offset += LENGTH_FORMAT.size
+                if len(data) - offset < length:
+                    raise Exception('Truncated batch file {}'.format(path))
+                yield data[offset:offset + length]
+                offset += length
+
+
+def submit_file(client, path, rate=None):
+    '''POST every BatchList in a batch file to the REST API, in order.
+
+       The serialized bytes are sent as they are, without parsing or
+       re-signing.  With 'rate', BatchLists are sent at that many per
+       second on a fixed schedule; otherwise as fast as the REST API
+       accepts them.  Returns a report of what was sent and how fast.
+    '''
+    interval = 1.0 / rate if rate else 0
+    batch_lists = 0
+    sent_bytes = 0
+    start = time.perf_counter()
+    for record in iter_records(path):
+        if interval:
+            delay = start + batch_lists * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        client._send_to_rest_api("batches", record,
+                                 'application/octet-stream')
+        batch_lists += 1
+        sent_bytes += len(record)
+    elapsed = time.perf_counter() - start
+    return {
+        'batch_lists': batch_lists,
+        'bytes': sent_bytes,
+        'seconds': elapsed,
+        'batch_lists_per_second': batch_lists / elapsed if elapsed else None,
+        'bytes_per_second': sent_bytes / elapsed if elapsed else None,
+    }
@@ -0,0 +1,181 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+Applies a stream of cookie jar operations through one process, for
+migrations and scripts that would otherwise run the CLI once per operation.
+
+Each input line is a JSON object such as
+    {"action": "bake", "amount": 5, "jar": "pantry", "id": "row-17"}
+where "jar" (default the unnamed jar) and "id" (echoed back) are
+optional and "amount" is ignored by count and clear.  Each output line
+is a JSON object with the input line number, the id, the action and
+either the batch "status" (or the "count") or an "error".  With no wait
+for commits, the status of an accepted batch is SUBMITTED.
+'''
+
+import collections
+import json
+
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+from cookiejar_client import FAMILY_VERSION
+from cookiejar_client import get_client
+from cookiejar_status import BatchStatusTracker
+
+# Operations submitted or waiting for commit at once.
+DEFAULT_MAX_IN_FLIGHT = 32
+# Seconds each bake, eat or clear waits for its batch to commit.
+DEFAULT_WAIT = 10
+
+ACTIONS = ('bake', 'eat', 'count', 'clear')
+# Statuses of operations that succeeded: committed, or accepted by the
+# REST API when not waiting for commits.
+SUCCESS_STATUSES = ('COMMITTED', 'SUBMITTED')
+
+
+def parse_operation(line):
+    '''Return the operation dictionary of one input line.'''
+    operation = json.loads(line)
+    if not isinstance(operation, dict):
+        raise ValueError('Operation must be a JSON object')
+    if operation.get('action') not in ACTIONS:
+        raise ValueError('Unknown action: {}'.format(operation.get('action')))
+    if operation['action'] in ('bake', 'eat'):
+        amount = operation.get('amount')
+        if not isinstance(amount, int) or isinstance(amount, bool) or \
+                amount < 0:
+            raise ValueError('amount must be a non-negative integer')
+    jar = operation.get('jar', '')
+    if not isinstance(jar, str):
+        raise ValueError('jar must be a string')
+    return operation
+
+
+def _batch_status(result):
+    '''Return the batch status from a bake, eat or clear result.'''
+    try:
+        return json.loads(result)['data'][0]['status']
+    except (ValueError, KeyError, IndexError, TypeError):
+        # "Transaction timed out after waiting ..."
+        return 'PENDING'
+
+
+class BulkRunner(object):
+    '''Applies operations with up to max_in_flight of them outstanding.
+
+    Every operation goes through the long-lived client of its jar from
+    get_client(), and all of them share one BatchStatusTracker, so commits
+    are confirmed with bulk status requests.  Operations on the same jar
+    run one after another, in input order; operations on different jars
+    overlap.  Results are produced in input order.
+    '''
+
+    def __init__(self, base_url, key_file,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, wait=DEFAULT_WAIT,
+                 family_version=FAMILY_VERSION):
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1')
+        self._base_url = base_url
+        self._key_file = key_file
+        self._family_version = family_version
+        self._max_in_flight = max_in_flight
+        self._wait = wait
+        self._tracker = BatchStatusTracker(get_client(base_url, key_file))
+        self._executor = ThreadPoolExecutor(max_in_flight)
+        # jar -> Future of the last operation submitted on it
+        self._last = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, trace):
+        self.close()
+
+    def close(self):
+        '''Wait for outstanding operations and stop the worker threads.'''
+        self._executor.shutdown()
+        self._tracker.stop()
+
+    def run(self, lines):
+        '''Yield one result dictionary per input line, in order.
+
+           Blank lines are skipped.  A line that does not parse yields an
+           error result without stopping the run.
+        '''
+        in_flight = collections.deque()
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            in_flight.append(self._submit(number, line))
+            if len(in_flight) >= self._max_in_flight:
+                yield self._result(*in_flight.popleft())
+        while in_flight:
+            yield self._result(*in_flight.popleft())
+
+    def _submit(self, number, line):
+        '''Return (jar, Future of the result) for one input line.'''
+        try:
+            operation = parse_operation(line)
+        except ValueError as err:
+            future = Future()
+            future.set_result({'line': number, 'error': str(err)})
+            return None, future
+        jar = operation.get('jar', '')
+        future = self._executor.submit(self._apply, number, operation,
+                                       self._last.get(jar))
+        self._last[jar] = future
+        return jar, future
+
+    def _result(self, jar, future):
+        result = future.result()
+        # Forget finished jars, so memory does not grow with their number.
+        if self._last.get(jar) is future:
+            del self._last[jar]
+        return result
+
+    def _apply(self, number, operation, previous):
+        if previous is not None:
+            # Earlier operations on this jar were submitted first, so
+            # they are running or done; the pool cannot deadlock here.
+            previous.result()
+        result = {'line': number, 'action': operation['action']}
+        if 'id' in operation:
+            result['id'] = operation['id']
+        try:
+            client = self._client(operation.get('jar', ''))
+            action = operation['action']
+            if action == 'count':
+                result['count'] = client.count()
+                return result
+            if action == 'bake':
+                response = client._wrap_and_send(
+                    'bake', operation['amount'], wait=self._wait)
+            elif action == 'eat':
+                response = client._wrap_and_send(
+                    'eat', operation['amount'], wait=self._wait)
+            else:
+                response = client._wrap_and_send('clear', 0, wait=self._wait)
+            result['status'] = _batch_status(response) \
+                if self._wait and self._wait > 0 else 'SUBMITTED'
+        except Exception as err:
+            result['error'] = str(err)
+        return result
+
+    def _client(self, jar):
+        client = get_client(self._base_url, self._key_file, jar,
+                            self._family_version)
+        client.set_status_tracker(self._tracker)
+        return client
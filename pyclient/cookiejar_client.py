@@ -17,13 +17,22 @@ CookieJarClient class interfaces with Sawtooth through the REST API.
 It accepts input from a client CLI/GUI/BUI or other interface.
 '''
 
+import functools
+import itertools
 import hashlib
 import base64
+import json
+import logging
 import random
+import struct
 import time
 import requests
-import yaml
 
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from urllib.parse import urlparse
+
+from cookiejar_metrics import NULL_TIMER
 from sawtooth_signing import create_context
 from sawtooth_signing import CryptoFactory
 from sawtooth_signing import ParseError
@@ -34,51 +43,324 @@ from sawtooth_sdk.protobuf.batch_pb2 import BatchList
 from sawtooth_sdk.protobuf.batch_pb2 import BatchHeader
 from sawtooth_sdk.protobuf.batch_pb2 import Batch
 
+LOGGER = logging.getLogger(__name__)
+
 # The Transaction Family Name
 FAMILY_NAME = 'cookiejar'
 # TF Prefix is first 6 characters of SHA-512("cookiejar"), a4d219
 
+# Version 1.0 payloads are CSV "action,amount" and state is the count as a
+# decimal ASCII string.  Version 1.1, the default, uses one or more fixed
+# 9-byte records per payload, each a 1-byte action code then the amount as
+# an unsigned 64-bit big-endian integer, which the processor applies in
+# order and atomically.  It stores state as a 1-byte format tag then the
+# count in the same form.  count() reads either state form.
+# A ("shard", n) operation makes the operations after it apply to shard n
+# of a sharded jar.  A ("jar", name) operation makes the operations after
+# it apply to shard 0 of the named jar; its record's amount is the length
+# of the UTF-8 name, which follows the record.  The empty name is the
+# signer's default jar.
+FAMILY_VERSION = '1.1'
+ACTION_CODES = {"bake": 1, "eat": 2, "clear": 3, "shard": 4, "jar": 5}
+MAX_SHARDS = 256
+MAX_JAR_NAME_LENGTH = 64
+SHARD_POLICIES = ('hash', 'round-robin')
+PAYLOAD_FORMAT = struct.Struct('>BQ')
+STATE_FORMAT = struct.Struct('>BQ')
+STATE_TAG = 1
+_STATE_TAG_BYTE = bytes([STATE_TAG])
+
+# Batch packing limits used by CookieJarBatchBuilder.  The byte limit
+# matches the REST API's default client_max_size for a POST to /batches;
+# the count limits keep each batch and batch list comfortably within what
+# the validator accepts and publishes in one block.
+MAX_TRANSACTIONS_PER_BATCH = 100
+MAX_BATCHES_PER_BATCH_LIST = 100
+MAX_BATCH_LIST_BYTES = 10 * 1024 * 1024
+# Upper bound on the protobuf tag plus length prefix of one repeated batch.
+_REPEATED_FIELD_OVERHEAD = 6
+# Batch IDs per batch_statuses query, keeping the URL to a sane length.
+STATUS_IDS_PER_REQUEST = 50
+# State entries per page when listing state; the REST API's maximum.
+STATE_PAGE_SIZE = 1000
+
+# REST API connection pool defaults.  The timeout (in seconds) applies to
+# each request, on top of any server-side wait for batch statuses.
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.2
+# 429 is returned while the validator's queue is full, 503 while the
+# validator is unavailable.  Resending a batch is harmless: the validator
+# drops duplicate batch IDs.
+RETRY_STATUS_CODES = (429, 503)
+
 def _hash(data):
     return hashlib.sha512(data).hexdigest()
 
+class RestApiError(Exception):
+    '''An error response from the REST API, with its HTTP status code.'''
+
+    def __init__(self, status_code, reason):
+        super().__init__("Error {}: {}".format(status_code, reason))
+        self.status_code = status_code
+
+def encode_payload(action, amount, family_version=FAMILY_VERSION):
+    '''Return the payload for one action in the given family version.'''
+    if family_version == '1.0':
+        # Generate a CSV UTF-8 encoded string as the payload.
+        return ",".join([action, str(amount)]).encode()
+    return PAYLOAD_FORMAT.pack(ACTION_CODES[action], amount)
+
+def _encode_jar_name(name):
+    data = name.encode('utf-8')
+    if len(data) > MAX_JAR_NAME_LENGTH or '#' in name:
+        raise Exception('Invalid jar name: {}'.format(name))
+    return data
+
+def encode_operations(operations):
+    '''Return a version 1.1 payload for a list of (action, amount).
+
+       The amount of a "jar" operation is the jar name.
+    '''
+    records = []
+    for action, amount in operations:
+        if action == "jar":
+            name = _encode_jar_name(amount)
+            records.append(PAYLOAD_FORMAT.pack(ACTION_CODES[action],
+                                               len(name)) + name)
+        else:
+            records.append(PAYLOAD_FORMAT.pack(ACTION_CODES[action], amount))
+    return b''.join(records)
+
+def decode_operations(payload, family_version=FAMILY_VERSION):
+    '''Return the list of (action, amount) in a payload; the inverse of
+       encode_payload() and encode_operations().
+    '''
+    if family_version == '1.0':
+        action, amount = payload.decode().split(",")
+        return [(action, int(amount))]
+    actions = {value: key for key, value in ACTION_CODES.items()}
+    operations = []
+    offset = 0
+    while offset < len(payload):
+        code, amount = PAYLOAD_FORMAT.unpack_from(payload, offset)
+        offset += PAYLOAD_FORMAT.size
+        if actions[code] == "jar":
+            name = payload[offset:offset + amount]
+            offset += amount
+            amount = name.decode('utf-8')
+        operations.append((actions[code], amount))
+    return operations
+
+def decode_count(data):
+    '''Return the cookie count from cookie jar state data of either
+       family version.
+    '''
+    if data[0:1] == _STATE_TAG_BYTE:
+        return STATE_FORMAT.unpack(data)[1]
+    return int(data)
+
+def encode_count(count, family_version=FAMILY_VERSION):
+    '''Return cookie jar state data for count in the given version.'''
+    if family_version == '1.0':
+        return str(count).encode('utf-8')
+    return STATE_FORMAT.pack(STATE_TAG, count)
+
+def _random_nonce():
+    return random.random().hex()
+
+NAMESPACE = _hash(FAMILY_NAME.encode('utf-8'))[0:6]
+
+@functools.lru_cache(maxsize=4096)
+def cookiejar_address(public_key, shard=0, jar=''):
+    '''Return the address of a cookie jar, or of one shard of it.
+
+       The address is the 6-char TF prefix plus the first 64 hex digits of
+       SHA-512 of the public key.  A named jar hashes the public key
+       followed by "/" and the name.  Shard 0 is the jar's usual address;
+       other shards hash the above followed by "#" and the shard.
+    '''
+    if jar:
+        public_key = '{}/{}'.format(public_key, jar)
+    if shard:
+        public_key = '{}#{}'.format(public_key, shard)
+    return NAMESPACE + _hash(public_key.encode('utf-8'))[0:64]
+
+@functools.lru_cache(maxsize=None)
+def create_signer(private_key_str):
+    '''Return a Signer for a hex private key, parsing each key only once.'''
+    try:
+        private_key = Secp256k1PrivateKey.from_hex(private_key_str)
+    except ParseError as err:
+        raise Exception( \
+            'Failed to load private key: {}'.format(str(err)))
+
+    return CryptoFactory(create_context('secp256k1')) \
+        .new_signer(private_key)
+
+def read_private_key(key_file):
+    '''Return the hex private key stored in key_file.'''
+    try:
+        with open(key_file) as key_fd:
+            return key_fd.read().strip()
+    except OSError as err:
+        raise Exception(
+            'Failed to read private key {}: {}'.format(
+                key_file, str(err)))
+
+@functools.lru_cache(maxsize=None)
+def load_signer(key_file):
+    '''Return a Signer for the private key in key_file.
+
+       The file is read only once per process.
+    '''
+    return create_signer(read_private_key(key_file))
+
+def _batch_ids(batch_list):
+    return [batch.header_signature for batch in batch_list.batches]
+
+def create_rest_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES,
+                        backoff_factor=DEFAULT_BACKOFF_FACTOR):
+    '''Return a requests Session with a keep-alive connection pool.
+
+       Connections to the REST API are reused across requests.  Requests
+       answered with 429 or 503, or that fail to connect, are retried up to
+       'retries' times with exponential backoff.  The session may be shared
+       by several CookieJarClients and threads; pool_size bounds the number
+       of connections kept open per host.
+    '''
+    retry_args = dict(total=retries, connect=retries, read=0,
+                      status=retries, backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUS_CODES,
+                      raise_on_status=False)
+    methods = frozenset(['GET', 'POST'])
+    try:
+        retry = Retry(allowed_methods=methods, **retry_args)
+    except TypeError:
+        # urllib3 before 1.26 names this option method_whitelist.
+        retry = Retry(method_whitelist=methods, **retry_args)
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_CLIENTS = {}
+
+def get_client(base_url, key_file, jar='', family_version=FAMILY_VERSION):
+    '''Return a long-lived CookieJarClient for base_url and key_file.
+
+       Clients are cached, so repeated calls in one process share the
+       signer, the header template and the REST API connection pool.
+    '''
+    key = (base_url, key_file, jar, family_version)
+    client = _CLIENTS.get(key)
+    if client is None:
+        client = _CLIENTS.setdefault(
+            key, CookieJarClient(base_url, key_file, jar=jar,
+                                 family_version=family_version))
+    return client
+
 class CookieJarClient(object):
     '''Client Cookie Jar class
 
     Supports "bake", "eat", and "count" functions.
+
+    With shards > 1 the jar's count is spread over that many addresses, so
+    the validator's parallel scheduler can run bakes to one jar
+    concurrently.  Each bake goes to one shard, chosen by a hash of the
+    transaction nonce or round-robin; eat() reads the shards and debits
+    one that holds enough cookies, or several if it must; count() sums the
+    shards and clear() empties them all.
+
+    One key may own many named jars.  bake(), eat(), count() and clear()
+    act on the client's jar, by default the key's unnamed jar; the
+    *_jars() methods act on several named jars at once.
     '''
 
-    def __init__(self, base_url, key_file=None):
+    def __init__(self, base_url, key_file=None, session=None,
+                 timeout=DEFAULT_TIMEOUT, signer=None, nonce_source=None,
+                 family_version=FAMILY_VERSION, shards=1,
+                 shard_policy='hash', jar='', metrics=None):
         '''Initialize the client class.
 
            This is mainly getting the key pair and computing the address.
+           The signer comes from 'signer' if given, otherwise from
+           load_signer(key_file).
+           'nonce_source' is a callable returning a unique nonce string per
+           transaction; a fixed source makes the signed bytes reproducible.
+           'family_version' selects the payload encoding; use '1.0' with
+           transaction processors that only support CSV payloads.
+           'shards' and 'shard_policy' enable a sharded jar (version 1.1
+           or later); every client of one jar must use the same 'shards'.
+           'jar' names the jar this client acts on (version 1.1 or later).
+           'metrics', a ClientMetrics, times each phase of a submission.
+           REST API requests go through 'session', which defaults to a new
+           pooled session from create_rest_session().  Pass one session to
+           several clients to share its connections.
         '''
         self._base_url = base_url
-
-        if key_file is None:
-            self._signer = None
+        self._timeout = timeout
+        self._owns_session = session is None
+        self._session = create_rest_session() if session is None else session
+        self._status_tracker = None
+        self._metrics = metrics
+        self._nonce_source = _random_nonce if nonce_source is None \
+            else nonce_source
+        self._family_version = family_version
+        if not 1 <= shards <= MAX_SHARDS:
+            raise Exception('shards must be between 1 and {}'.format(
+                MAX_SHARDS))
+        if shards > 1 and family_version == '1.0':
+            raise Exception('Sharded jars need family version 1.1')
+        if shard_policy not in SHARD_POLICIES:
+            raise Exception('Unknown shard policy: {}'.format(shard_policy))
+        if jar and family_version == '1.0':
+            raise Exception('Named jars need family version 1.1')
+        if jar:
+            _encode_jar_name(jar)
+        self._jar = jar
+        self._shards = shards
+        self._shard_policy = shard_policy
+        self._shard_counter = itertools.count()
+
+        if signer is None and key_file is not None:
+            signer = load_signer(key_file)
+        self._signer = signer
+        if signer is None:
             return
 
-        try:
-            with open(key_file) as key_fd:
-                private_key_str = key_fd.read().strip()
-        except OSError as err:
-            raise Exception(
-                'Failed to read private key {}: {}'.format(
-                    key_file, str(err)))
-
-        try:
-            private_key = Secp256k1PrivateKey.from_hex(private_key_str)
-        except ParseError as err:
-            raise Exception( \
-                'Failed to load private key: {}'.format(str(err)))
-
-        self._signer = CryptoFactory(create_context('secp256k1')) \
-            .new_signer(private_key)
-        self._public_key = self._signer.get_public_key().as_hex()
+        self._public_key = signer.get_public_key().as_hex()
 
         # Address is 6-char TF prefix + hash of "mycookiejar"'s public key
-        self._address = _hash(FAMILY_NAME.encode('utf-8'))[0:6] + \
-            _hash(self._public_key.encode('utf-8'))[0:64]
+        # (and the jar name, for a named jar).
+        self._address = cookiejar_address(self._public_key, 0, jar)
+        self._shard_addresses = self._jar_addresses(jar)
+
+        # Everything in the TransactionHeader but the nonce and payload
+        # hash is the same for every transaction from this client to the
+        # same addresses.  Unsharded jars have one input and output
+        # address (the same one).
+        self._header_template = self._new_header_template([self._address])
+        self._header_templates = {(self._address,): self._header_template}
+
+    def _jar_addresses(self, jar):
+        '''Return the address of each shard of a jar of this client.'''
+        return [cookiejar_address(self._public_key, shard, jar)
+                for shard in range(self._shards)]
+
+    def _new_header_template(self, addresses):
+        return TransactionHeader(
+            signer_public_key=self._public_key,
+            family_name=FAMILY_NAME,
+            family_version=self._family_version,
+            inputs=addresses,
+            outputs=addresses,
+            dependencies=[],
+            batcher_public_key=self._public_key)
 
     # For each CLI command, add a method to:
     # 1. Do any additional handling, if required
@@ -91,19 +373,97 @@ class CookieJarClient(object):
     def eat(self, amount):
         '''Eat amount cookies from the cookie jar.'''
         try:
-            ret_amount = self._wrap_and_send("eat", amount, wait=10)
+            if self._shards > 1:
+                transaction = self._create_sharded_eat(amount)
+                ret_amount = self._send_batch_list(
+                    BatchList(batches=[self._create_batch([transaction])]),
+                    wait=10)
+            else:
+                ret_amount = self._wrap_and_send("eat", amount, wait=10)
         except Exception:
             raise Exception('Encountered an error during eat')
         return ret_amount
 
     def count(self):
         '''Count the number of cookies in the cookie jar.'''
-        result = self._send_to_rest_api("state/{}".format(self._address))
+        return self._jar_count(self._jar)
+
+    def count_jars(self, jars):
+        '''Return a dictionary of jar name to count, or None for jars
+           that do not exist.
+        '''
+        return {jar: self._jar_count(jar) for jar in jars}
+
+    def apply_jar_operations(self, jar_operations, wait=10):
+        '''Apply operations to several named jars in bulk.
+
+           'jar_operations' maps each jar name to a list of (action,
+           amount) pairs, e.g. {"a": [("bake", 5)], "b": [("eat", 1)]}.
+           Each jar's operations are one atomic transaction; the
+           transactions are packed into as few batches as the batch
+           limits allow.  Returns the results of
+           CookieJarBatchBuilder.submit().
+        '''
+        builder = self.new_batch_builder()
+        for jar, operations in dict(jar_operations).items():
+            builder.add_operations(operations, jar=jar)
+        return builder.submit(wait)
+
+    def bake_jars(self, amounts, wait=10):
+        '''Bake amounts[name] cookies in each named jar.'''
+        return self.apply_jar_operations(
+            {jar: [("bake", amount)] for jar, amount in amounts.items()},
+            wait)
+
+    def clear_jars(self, jars, wait=10):
+        '''Empty each of the named jars.'''
+        return self.apply_jar_operations(
+            {jar: [("clear", 0)] for jar in jars}, wait)
+
+    def _jar_count(self, jar):
+        if self._shards > 1:
+            counts = [count for count in self._shard_counts(jar)
+                      if count is not None]
+            return sum(counts) if counts else None
+        return self._get_count(cookiejar_address(self._public_key, 0, jar))
+
+    def iter_counts(self, address_prefix=NAMESPACE,
+                    page_size=STATE_PAGE_SIZE):
+        '''Yield (address, count) for every cookie jar in the namespace.
+
+           Walks GET /state?address=<address_prefix> one page at a time,
+           so memory use is bounded by page_size however many jars exist.
+           Later pages follow the REST API's paging.next link, which pins
+           the head block of the first page, so the counts form one
+           consistent snapshot.  Pass a longer prefix to read a subset.
+        '''
+        suffix = "state?address={}&limit={}".format(address_prefix,
+                                                    page_size)
+        while suffix:
+            page = json.loads(self._send_to_rest_api(suffix))
+            for entry in page['data']:
+                yield entry['address'], \
+                    decode_count(base64.b64decode(entry['data']))
+            next_url = page.get('paging', {}).get('next')
+            suffix = "state?{}".format(urlparse(next_url).query) \
+                if next_url else None
+
+    def _get_count(self, address):
+        '''Return the count stored at address, or None if there is none.'''
         try:
-            return base64.b64decode(yaml.safe_load(result)["data"])
-        except BaseException:
-            return None
-			
+            result = self._send_to_rest_api("state/{}".format(address))
+        except RestApiError as err:
+            if err.status_code == 404:
+                return None
+            raise
+        return decode_count(base64.b64decode(json.loads(result)["data"]))
+
+    def _shard_counts(self, jar=None):
+        '''Return the count in each shard, None where it does not exist.'''
+        addresses = self._shard_addresses if jar in (None, self._jar) \
+            else self._jar_addresses(jar)
+        return [self._get_count(address) for address in addresses]
+
     def clear(self):
         '''Empty the cookie jar.'''
         try:
@@ -112,32 +472,73 @@ class CookieJarClient(object):
             raise Exception('Encountered an error during clear')
         return ret_amount
 
-    def _send_to_rest_api(self, suffix, data=None, content_type=None):
+    def apply_operations(self, operations):
+        '''Apply a list of (action, amount) pairs, for example
+           [("bake", 5), ("eat", 3), ("eat", 1)], as one transaction.
+
+           The operations are applied in order with one state read and
+           one write.  If any eat would go below zero, none of them apply.
+        '''
+        transaction = self._create_operations_transaction(operations)
+        batch_list = BatchList(batches=[self._create_batch([transaction])])
+        return self._send_batch_list(batch_list, wait=10)
+
+    def set_status_tracker(self, tracker):
+        '''Resolve batch statuses through 'tracker', e.g. a
+           BatchStatusTracker, instead of polling each batch.
+        '''
+        self._status_tracker = tracker
+
+    def set_metrics(self, metrics):
+        '''Time each phase of a submission with 'metrics', a
+           ClientMetrics, or stop timing with None.
+        '''
+        self._metrics = metrics
+
+    def _span(self, name, **attributes):
+        '''Return a context manager timing phase 'name', if enabled.'''
+        if self._metrics is None:
+            return NULL_TIMER
+        return self._metrics.span(name, **attributes)
+
+    def close(self):
+        '''Close the REST API connections, unless the session was shared.'''
+        if self._owns_session:
+            self._session.close()
+
+    def _send_to_rest_api(self, suffix, data=None, content_type=None,
+                          wait=0):
         '''Send a REST command to the Validator via the REST API.
 
            Called by count() &  _wrap_and_send().
            The latter caller is made on the behalf of bake() & eat().
+           'wait' is how long the REST API may hold the request open.
         '''
         url = "{}/{}".format(self._base_url, suffix)
-        print("URL to send to REST API is {}".format(url))
+        LOGGER.debug("Sending %s %s", "POST" if data is not None else "GET",
+                     url)
 
         headers = {}
 
         if content_type is not None:
             headers['Content-Type'] = content_type
 
+        timeout = self._timeout + wait
         try:
             if data is not None:
-                result = requests.post(url, headers=headers, data=data)
+                result = self._session.post(url, headers=headers, data=data,
+                                            timeout=timeout)
             else:
-                result = requests.get(url, headers=headers)
+                result = self._session.get(url, headers=headers,
+                                           timeout=timeout)
 
             if not result.ok:
-                raise Exception("Error {}: {}".format(
-                    result.status_code, result.reason))
+                raise RestApiError(result.status_code, result.reason)
         except requests.ConnectionError as err:
             raise Exception(
                 'Failed to connect to {}: {}'.format(url, str(err)))
+        except RestApiError:
+            raise
         except BaseException as err:
             raise Exception(err)
 
@@ -146,6 +547,8 @@ class CookieJarClient(object):
     def _wait_for_status(self, batch_id, wait, result):
         '''Wait until transaction status is not PENDING (COMMITTED or error).
 
+           'batch_id' may be a comma-separated list of batch IDs, in which
+           case all of them must leave the PENDING state.
            'wait' is time to wait for status, in seconds.
         '''
         if wait and wait > 0:
@@ -153,11 +556,13 @@ class CookieJarClient(object):
             start_time = time.time()
             while waited < wait:
                 result = self._send_to_rest_api("batch_statuses?id={}&wait={}"
-                                               .format(batch_id, wait))
-                status = yaml.safe_load(result)['data'][0]['status']
+                                               .format(batch_id, wait),
+                                               wait=wait)
+                statuses = [batch_status['status'] for batch_status
+                            in json.loads(result)['data']]
                 waited = time.time() - start_time
 
-                if status != 'PENDING':
+                if 'PENDING' not in statuses:
                     return result
             return "Transaction timed out after waiting {} seconds." \
                .format(wait)
@@ -165,64 +570,334 @@ class CookieJarClient(object):
             return result
 
 
-    def _wrap_and_send(self, action, amount, wait=None):
-        '''Create a transaction, then wrap it in a batch.
-
-           Even single transactions must be wrapped into a batch.
-           Called by bake() and eat().
+    def new_batch_builder(self, **kwargs):
+        '''Return a CookieJarBatchBuilder that packs operations for this
+           client's cookie jar into multi-transaction batches.
         '''
+        return CookieJarBatchBuilder(self, **kwargs)
 
-        # Generate a CSV UTF-8 encoded string as the payload.
-        raw_payload = ",".join([action, str(amount)])
-        payload = raw_payload.encode() # Convert Unicode to bytes
+    def _create_transaction(self, action, amount, nonce=None, shard=None):
+        '''Create and sign a Transaction for one bake/eat/clear action.
+
+           The nonce defaults to the next value from the nonce source.
+           For a sharded jar, a bake goes to 'shard' or else the shard
+           picked by the shard policy, an eat goes to 'shard' or else
+           shard 0, and a clear empties every shard.
+        '''
+        if nonce is None:
+            nonce = self._nonce_source()
+        with self._span('payload', action=action):
+            payload, addresses = self._encode_action(action, amount, nonce,
+                                                     shard)
+        return self._sign_transaction(payload, nonce, addresses)
+
+    def _encode_action(self, action, amount, nonce, shard):
+        '''Return the payload and addresses for one action.'''
+        if self._shards == 1 and not self._jar:
+            return encode_payload(action, amount, self._family_version), None
+
+        if self._shards == 1:
+            return encode_operations([("jar", self._jar),
+                                      (action, amount)]), None
+        if action == "clear":
+            shards = range(self._shards)
+        elif shard is not None:
+            shards = [shard]
+        elif action == "bake":
+            shards = [self._choose_shard(nonce)]
+        else:
+            shards = [0]
+        operations = [("jar", self._jar)] if self._jar else []
+        for shard in shards:
+            operations.extend([("shard", shard), (action, amount)])
+        return encode_operations(operations), \
+            [self._shard_addresses[shard] for shard in shards]
+
+    def _choose_shard(self, nonce):
+        if self._shard_policy == 'round-robin':
+            return next(self._shard_counter) % self._shards
+        return int(_hash(nonce.encode())[0:8], 16) % self._shards
+
+    def _create_sharded_eat(self, amount):
+        '''Create an eat for a sharded jar from the current shard counts.
+
+           Eats from the fullest shard if it holds enough cookies,
+           otherwise from as many shards as needed, fullest first.  If the
+           whole jar holds too few, the eat targets the fullest shard and
+           the transaction processor rejects it.
+        '''
+        counts = [(count or 0, shard)
+                  for shard, count in enumerate(self._shard_counts())]
+        counts.sort(reverse=True)
+        if counts[0][0] >= amount or \
+                sum(count for count, _ in counts) < amount:
+            return self._create_transaction("eat", amount,
+                                            shard=counts[0][1])
+
+        operations = [("jar", self._jar)] if self._jar else []
+        shards = []
+        remaining = amount
+        for count, shard in counts:
+            if remaining <= 0:
+                break
+            take = min(count, remaining)
+            if take > 0:
+                operations.extend([("shard", shard), ("eat", take)])
+                shards.append(shard)
+                remaining -= take
+        return self._sign_transaction(
+            encode_operations(operations), None,
+            [self._shard_addresses[shard] for shard in shards])
+
+    def _create_operations_transaction(self, operations, nonce=None,
+                                       jar=None):
+        '''Create and sign one Transaction for a list of (action, amount).
+
+           The operations apply to the named jar, by default the client's
+           jar, unless they select other jars or shards themselves.
+           Needs family version 1.1 or later.
+        '''
+        if self._family_version == '1.0':
+            raise Exception('Family version 1.0 supports one operation '
+                            'per transaction')
+        if jar is None:
+            jar = self._jar
+        with self._span('payload', action='operations'):
+            if jar:
+                operations = [("jar", jar)] + list(operations)
+            payload = encode_operations(operations)
+            addresses = self._operation_addresses(operations)
+        return self._sign_transaction(payload, nonce, addresses)
+
+    def _operation_addresses(self, operations):
+        '''Return the addresses that a list of operations touches.'''
+        jar = ''
+        shard = 0
+        addresses = []
+        for action, amount in operations:
+            if action == "jar":
+                jar, shard = amount, 0
+            elif action == "shard":
+                shard = amount
+            else:
+                address = cookiejar_address(self._public_key, shard, jar)
+                if address not in addresses:
+                    addresses.append(address)
+        return addresses
 
-        # Construct the address where we'll store our state.
-        # We just have one input and output address (the same one).
-        input_and_output_address_list = [self._address]
+    def _sign_transaction(self, payload, nonce=None, addresses=None):
+        '''Create and sign a Transaction for an encoded payload.
 
-        # Create a TransactionHeader.
-        header = TransactionHeader(
-            signer_public_key=self._public_key,
-            family_name=FAMILY_NAME,
-            family_version="1.0",
-            inputs=input_and_output_address_list,
-            outputs=input_and_output_address_list,
-            dependencies=[],
-            payload_sha512=_hash(payload),
-            batcher_public_key=self._public_key,
-            nonce=random.random().hex().encode()
-        ).SerializeToString()
+           'addresses' are the transaction's inputs and outputs, by
+           default the jar's address.
+        '''
+        if addresses is None:
+            template = self._header_template
+        else:
+            template = self._header_templates.get(tuple(addresses))
+            if template is None:
+                template = self._new_header_template(addresses)
+                self._header_templates[tuple(addresses)] = template
+
+        # Create a TransactionHeader from the template.
+        with self._span('header'):
+            header = TransactionHeader()
+            header.CopyFrom(template)
+            header.payload_sha512 = _hash(payload)
+            header.nonce = self._nonce_source() if nonce is None else nonce
+            header = header.SerializeToString()
+
+        with self._span('sign'):
+            signature = self._signer.sign(header)
 
         # Create a Transaction from the header and payload above.
-        transaction = Transaction(
+        return Transaction(
             header=header,
             payload=payload,
-            header_signature=self._signer.sign(header)
+            header_signature=signature
         )
 
-        transaction_list = [transaction]
+    def _create_batch(self, transaction_list):
+        '''Wrap a list of Transactions in a signed Batch.'''
 
-        # Create a BatchHeader from transaction_list above.
-        header = BatchHeader(
-            signer_public_key=self._public_key,
-            transaction_ids=[txn.header_signature for txn in transaction_list]
-        ).SerializeToString()
+        with self._span('batch', transactions=len(transaction_list)):
+            # Create a BatchHeader from transaction_list above.
+            header = BatchHeader(
+                signer_public_key=self._public_key,
+                transaction_ids=[txn.header_signature
+                                 for txn in transaction_list]
+            ).SerializeToString()
 
-        # Create Batch using the BatchHeader and transaction_list above.
-        batch = Batch(
-            header=header,
-            transactions=transaction_list,
-            header_signature=self._signer.sign(header))
+            # Create Batch using the BatchHeader and transaction_list above.
+            return Batch(
+                header=header,
+                transactions=transaction_list,
+                header_signature=self._signer.sign(header))
 
-        # Create a Batch List from Batch above
-        batch_list = BatchList(batches=[batch])
-        batch_id = batch_list.batches[0].header_signature
+    def _send_batch_list(self, batch_list, wait=None):
+        '''Send a BatchList to the REST API and optionally wait for it.
+
+           Returns the REST API response, or the batch status once every
+           batch in the list is no longer PENDING.
+        '''
+        batch_ids = _batch_ids(batch_list)
 
         # Send batch_list to the REST API
-        result = self._send_to_rest_api("batches",
-                                       batch_list.SerializeToString(),
-                                       'application/octet-stream')
+        with self._span('submit', batch_ids=batch_ids):
+            result = self._send_to_rest_api("batches",
+                                           batch_list.SerializeToString(),
+                                           'application/octet-stream')
 
         # Wait until transaction status is COMMITTED, error, or timed out
-        return self._wait_for_status(batch_id, wait, result)
+        return self._wait_for_batches(batch_ids, wait, result)
+
+    def _wait_for_batches(self, batch_ids, wait, result):
+        '''Wait until none of batch_ids is PENDING.
+
+           With a status tracker attached, all IDs are handed to it and
+           the statuses are returned in the REST API's response format.
+        '''
+        if not wait or wait <= 0:
+            return result
+        with self._span('commit', batch_ids=batch_ids):
+            if self._status_tracker is not None:
+                futures = [self._status_tracker.track(batch_id, timeout=wait)
+                           for batch_id in batch_ids]
+                statuses = [future.result() for future in futures]
+                if any(status['status'] == 'PENDING' for status in statuses):
+                    return "Transaction timed out after waiting {} " \
+                        "seconds.".format(wait)
+                return json.dumps({'data': statuses})
+            for start in range(0, len(batch_ids), STATUS_IDS_PER_REQUEST):
+                result = self._wait_for_status(
+                    ",".join(batch_ids[start:start + STATUS_IDS_PER_REQUEST]),
+                    wait, result)
+            return result
+
+    def _wrap_and_send(self, action, amount, wait=None):
+        '''Create a transaction, then wrap it in a batch.
+
+           Even single transactions must be wrapped into a batch.
+           Called by bake() and eat().
+        '''
+        transaction = self._create_transaction(action, amount)
+        batch = self._create_batch([transaction])
+
+        # Create a Batch List from Batch above
+        batch_list = BatchList(batches=[batch])
+        return self._send_batch_list(batch_list, wait)
+
+
+def pack_batch_lists(batches, batches_per_list=MAX_BATCHES_PER_BATCH_LIST,
+                     max_batch_list_bytes=MAX_BATCH_LIST_BYTES):
+    '''Group an iterable of Batches into BatchLists within the limits.
+
+       BatchLists are yielded as soon as they are full, so batches can be
+       produced and submitted in a stream.
+    '''
+    current = []
+    current_bytes = 0
+    for batch in batches:
+        # Each repeated message costs a tag and a length prefix as well.
+        batch_bytes = batch.ByteSize() + _REPEATED_FIELD_OVERHEAD
+        if current and \
+                (len(current) >= batches_per_list or
+                 current_bytes + batch_bytes > max_batch_list_bytes):
+            yield BatchList(batches=current)
+            current = []
+            current_bytes = 0
+        current.append(batch)
+        current_bytes += batch_bytes
+    if current:
+        yield BatchList(batches=current)
+
+
+class CookieJarBatchBuilder(object):
+    '''Collects bake/eat/clear operations and packs them into batches.
+
+    Operations are signed as they are added.  Every
+    transactions_per_batch transactions are sealed into a Batch, and
+    batches are grouped into BatchLists of at most batches_per_list
+    batches and max_batch_list_bytes serialized bytes, so one POST to
+    /batches can carry many operations.  Transactions within a batch are
+    applied in the order they were added, and the whole batch commits or
+    fails together.
+    '''
+
+    def __init__(self, client,
+                 transactions_per_batch=MAX_TRANSACTIONS_PER_BATCH,
+                 batches_per_list=MAX_BATCHES_PER_BATCH_LIST,
+                 max_batch_list_bytes=MAX_BATCH_LIST_BYTES):
+        if transactions_per_batch < 1 or batches_per_list < 1:
+            raise Exception('Batch size limits must be at least 1')
+        self._client = client
+        self._transactions_per_batch = transactions_per_batch
+        self._batches_per_list = batches_per_list
+        self._max_batch_list_bytes = max_batch_list_bytes
+        self._transactions = []
+        self._batches = []
+
+    def __len__(self):
+        '''Return the number of operations not yet taken by batch_lists().'''
+        return len(self._transactions) + \
+            sum(len(batch.transactions) for batch in self._batches)
 
+    def bake(self, amount):
+        '''Add an operation baking amount cookies.'''
+        self._add("bake", amount)
+
+    def eat(self, amount):
+        '''Add an operation eating amount cookies.'''
+        self._add("eat", amount)
+
+    def clear(self):
+        '''Add an operation emptying the cookie jar.'''
+        self._add("clear", 0)
+
+    def add_operations(self, operations, jar=None):
+        '''Add a list of (action, amount) pairs as one atomic transaction,
+           applied to the named jar or else the client's jar.
+        '''
+        self.add_transaction(
+            self._client._create_operations_transaction(operations, jar=jar))
+
+    def add_transaction(self, transaction):
+        '''Add an already signed Transaction.'''
+        self._transactions.append(transaction)
+        if len(self._transactions) >= self._transactions_per_batch:
+            self._seal_batch()
+
+    def _add(self, action, amount):
+        self.add_transaction(self._client._create_transaction(action, amount))
+
+    def _seal_batch(self):
+        if self._transactions:
+            self._batches.append(self._client._create_batch(self._transactions))
+            self._transactions = []
+
+    def batch_lists(self):
+        '''Seal any pending transactions and return the collected batches
+           as a list of BatchLists within the configured limits.
+
+           The builder is empty afterwards.
+        '''
+        self._seal_batch()
+        batch_lists = list(pack_batch_lists(self._batches,
+                                            self._batches_per_list,
+                                            self._max_batch_list_bytes))
+        self._batches = []
+        return batch_lists
+
+    def submit(self, wait=None):
+        '''Send every collected operation to the REST API.
+
+           One POST is made per BatchList.  Returns the list of responses
+           (or batch statuses, if wait is given), one per BatchList.
+           Every BatchList is sent before waiting on any of them.
+        '''
+        batch_lists = self.batch_lists()
+        results = [self._client._send_batch_list(batch_list)
+                   for batch_list in batch_lists]
+        return [self._client._wait_for_batches(_batch_ids(batch_list),
+                                               wait, result)
+                for batch_list, result in zip(batch_lists, results)]
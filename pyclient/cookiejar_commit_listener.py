@@ -0,0 +1,245 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+CommitListener confirms batch commits from the validator's block-commit
+events.  The REST API is asked once about newly tracked batches, which
+may have committed already, and again about batches that time out.
+'''
+
+import logging
+import threading
+import time
+
+from concurrent.futures import Future
+
+from sawtooth_sdk.messaging.stream import RECONNECT_EVENT
+from sawtooth_sdk.messaging.stream import Stream
+from sawtooth_sdk.protobuf import client_block_pb2
+from sawtooth_sdk.protobuf import client_event_pb2
+from sawtooth_sdk.protobuf import events_pb2
+from sawtooth_sdk.protobuf.validator_pb2 import Message
+
+from cookiejar_status import query_batch_statuses
+from events_client import DEFAULT_VALIDATOR_URL
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds to wait for a block-commit event before asking the REST API,
+# for batches tracked without a timeout (e.g. invalid batches, which
+# never appear in a block).
+DEFAULT_FALLBACK_TIMEOUT = 30
+
+
+def _batch_status(batch_id, status):
+    return {'id': batch_id, 'status': status, 'invalid_transactions': []}
+
+
+class CommitListener(object):
+    '''Resolves pending batches from sawtooth/block-commit events.
+
+    Offers the same track()/stop() interface as BatchStatusTracker, so it
+    can be passed to set_status_tracker() of a CookieJarClient.  For every
+    committed block, the listener fetches the block over the same validator
+    stream and resolves any tracked batch it contains as COMMITTED.
+    Newly tracked batches are checked once with the REST API, since they
+    may have committed before track() was called.  Batches still
+    unresolved at their timeout are checked with one bulk batch_statuses
+    request through 'client', which also reports INVALID batches.
+    '''
+
+    def __init__(self, client, validator_url=DEFAULT_VALIDATOR_URL,
+                 fallback_timeout=DEFAULT_FALLBACK_TIMEOUT):
+        '''Connect to the validator and subscribe to block-commit events.
+
+           'client' is a CookieJarClient used for the REST API fallback.
+        '''
+        self._client = client
+        self._fallback_timeout = fallback_timeout
+        # batch ID -> list of (Future, deadline)
+        self._pending = {}
+        # Batch IDs tracked since the last REST API check.
+        self._unchecked = set()
+        self._condition = threading.Condition()
+        self._stopped = False
+
+        self._stream = Stream(validator_url)
+        self._subscribe()
+
+        self._receiver = threading.Thread(target=self._receive,
+                                          name='CommitListenerReceiver')
+        self._receiver.daemon = True
+        self._receiver.start()
+        self._fallback = threading.Thread(target=self._check_timeouts,
+                                          name='CommitListenerFallback')
+        self._fallback.daemon = True
+        self._fallback.start()
+
+    def track(self, batch_id, callback=None, timeout=None):
+        '''Start tracking batch_id and return a Future for its status.
+
+           'callback', if given, is called with the status dictionary.
+           If no block-commit event includes the batch within 'timeout'
+           seconds (default fallback_timeout), its status is read from the
+           REST API instead.
+        '''
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(lambda done: callback(done.result()))
+        if timeout is None:
+            timeout = self._fallback_timeout
+        with self._condition:
+            if self._stopped:
+                raise Exception('Commit listener is stopped')
+            self._pending.setdefault(batch_id, []).append(
+                (future, time.time() + timeout))
+            # The block including the batch may have committed before
+            # this call, so the fallback thread checks it once now.
+            self._unchecked.add(batch_id)
+            self._condition.notify()
+        return future
+
+    def stop(self):
+        '''Close the validator stream.  Outstanding Futures are cancelled.'''
+        with self._condition:
+            self._stopped = True
+            pending = self._pending
+            self._pending = {}
+            self._condition.notify()
+        self._stream.close()
+        self._fallback.join()
+        for waiters in pending.values():
+            for future, _ in waiters:
+                future.cancel()
+
+    def _subscribe(self):
+        request = client_event_pb2.ClientEventsSubscribeRequest(
+            subscriptions=[events_pb2.EventSubscription(
+                event_type="sawtooth/block-commit")])
+        msg = self._stream.send(
+            message_type=Message.CLIENT_EVENTS_SUBSCRIBE_REQUEST,
+            content=request.SerializeToString()).result()
+        response = client_event_pb2.ClientEventsSubscribeResponse()
+        response.ParseFromString(msg.content)
+        if response.status != \
+                client_event_pb2.ClientEventsSubscribeResponse.OK:
+            raise Exception('Failed to subscribe to block-commit events: '
+                            '{}'.format(response.response_message))
+
+    def _receive(self):
+        while not self._stopped:
+            try:
+                msg = self._stream.receive().result()
+                if msg == RECONNECT_EVENT:
+                    # Subscriptions do not survive a reconnect.  Batches
+                    # committed meanwhile are caught by the REST fallback.
+                    self._subscribe()
+                    continue
+                if msg.message_type != Message.CLIENT_EVENTS:
+                    continue
+                event_list = events_pb2.EventList()
+                event_list.ParseFromString(msg.content)
+                for event in event_list.events:
+                    if event.event_type == "sawtooth/block-commit":
+                        self._on_block_commit(event)
+            except Exception as err:
+                if not self._stopped:
+                    LOGGER.warning('Commit listener receive failed: %s', err)
+
+    def _on_block_commit(self, event):
+        with self._condition:
+            if not self._pending:
+                return
+        block_id = next(attribute.value for attribute in event.attributes
+                        if attribute.key == 'block_id')
+        request = client_block_pb2.ClientBlockGetByIdRequest(
+            block_id=block_id)
+        msg = self._stream.send(
+            message_type=Message.CLIENT_BLOCK_GET_BY_ID_REQUEST,
+            content=request.SerializeToString()).result()
+        response = client_block_pb2.ClientBlockGetResponse()
+        response.ParseFromString(msg.content)
+        if response.status != client_block_pb2.ClientBlockGetResponse.OK:
+            LOGGER.warning('Failed to fetch committed block %s', block_id)
+            return
+        self._resolve({batch.header_signature:
+                       _batch_status(batch.header_signature, 'COMMITTED')
+                       for batch in response.block.batches})
+
+    def _check_timeouts(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    now = time.time()
+                    deadlines = [deadline
+                                 for waiters in self._pending.values()
+                                 for _, deadline in waiters]
+                    if self._unchecked or \
+                            (deadlines and min(deadlines) <= now):
+                        break
+                    self._condition.wait(
+                        min(deadlines) - now if deadlines else None)
+                if self._stopped:
+                    return
+                expired = [batch_id
+                           for batch_id, waiters in self._pending.items()
+                           if any(deadline <= now for _, deadline in waiters)]
+                checked = [batch_id for batch_id in self._unchecked
+                           if batch_id in self._pending and
+                           batch_id not in expired]
+                self._unchecked = set()
+            if not expired and not checked:
+                continue
+
+            try:
+                statuses = query_batch_statuses(self._client,
+                                                expired + checked)
+            except Exception as err:
+                LOGGER.warning('Batch status query failed: %s', err)
+                statuses = {}
+            for batch_id in expired:
+                statuses.setdefault(batch_id,
+                                    _batch_status(batch_id, 'PENDING'))
+            self._resolve(statuses, expired_before=now)
+
+    def _resolve(self, statuses, expired_before=None):
+        '''Resolve waiters of finished batches in 'statuses'.
+
+           With expired_before, waiters whose deadline has passed are
+           resolved even if their batch is still PENDING.
+        '''
+        done = []
+        with self._condition:
+            for batch_id, status in statuses.items():
+                waiters = self._pending.get(batch_id)
+                if not waiters:
+                    continue
+                if status['status'] != 'PENDING':
+                    finished, remaining = waiters, []
+                elif expired_before is not None:
+                    finished = [waiter for waiter in waiters
+                                if waiter[1] <= expired_before]
+                    remaining = [waiter for waiter in waiters
+                                 if waiter[1] > expired_before]
+                else:
+                    continue
+                done.extend((future, status) for future, _ in finished)
+                if remaining:
+                    self._pending[batch_id] = remaining
+                else:
+                    del self._pending[batch_id]
+
+        for future, status in done:
+            if future.set_running_or_notify_cancel():
+                future.set_result(status)
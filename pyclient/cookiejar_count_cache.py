@@ -0,0 +1,228 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+CountCache keeps cookie jar counts in memory, warmed by a bulk state read
+and kept current by the validator's sawtooth/state-delta events.
+'''
+
+import collections
+import logging
+import threading
+
+from sawtooth_sdk.messaging.stream import RECONNECT_EVENT
+from sawtooth_sdk.messaging.stream import Stream
+from sawtooth_sdk.protobuf import client_event_pb2
+from sawtooth_sdk.protobuf import events_pb2
+from sawtooth_sdk.protobuf import transaction_receipt_pb2
+from sawtooth_sdk.protobuf.validator_pb2 import Message
+
+from cookiejar_client import NAMESPACE
+from cookiejar_client import cookiejar_address
+from cookiejar_client import decode_count
+from events_client import DEFAULT_VALIDATOR_URL
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 100000
+
+
+class CountCache(object):
+    '''Read-through LRU cache of cookie jar counts.
+
+    count() answers from memory when it can and otherwise reads the jar
+    through 'client' and caches the result, evicting the least recently
+    used jar beyond max_size entries.  Jars that do not exist are cached
+    as None.
+
+    The cache subscribes to sawtooth/block-commit and to
+    sawtooth/state-delta for the cookiejar namespace, and applies each
+    block's state changes as one step, so readers see counts as of a
+    whole committed block.  'head' is the (block_id, block_num) of the
+    last block applied, the staleness marker of every cached count.  If
+    the chain forks or the validator connection drops, the cache is
+    emptied rather than serve counts it cannot vouch for.
+    '''
+
+    def __init__(self, client, validator_url=DEFAULT_VALIDATOR_URL,
+                 max_size=DEFAULT_MAX_SIZE, warm=True):
+        '''Subscribe to state changes and, with 'warm', load up to
+           max_size counts with CookieJarClient.iter_counts().
+        '''
+        self._client = client
+        self._max_size = max_size
+        # address -> count, or None for a jar that does not exist
+        self._counts = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._head = (None, None)
+        # Bumped whenever cached counts change, so a read-through that
+        # raced with a block does not cache its older count.
+        self._generation = 0
+        self._warming = False
+        self._stopped = False
+        self.hits = 0
+        self.misses = 0
+
+        self._stream = Stream(validator_url)
+        self._subscribe()
+        self._receiver = threading.Thread(target=self._receive,
+                                          name='CountCacheReceiver')
+        self._receiver.daemon = True
+        self._receiver.start()
+        if warm:
+            self.warm()
+
+    @property
+    def head(self):
+        '''Return (block_id, block_num) of the last block applied.'''
+        return self._head
+
+    def __len__(self):
+        return len(self._counts)
+
+    def count(self, address):
+        '''Return the count at address, or None if the jar does not exist.'''
+        with self._lock:
+            if address in self._counts:
+                self._counts.move_to_end(address)
+                self.hits += 1
+                return self._counts[address]
+            self.misses += 1
+            generation = self._generation
+
+        count = self._client._get_count(address)
+        with self._lock:
+            if self._generation == generation:
+                self._put(address, count)
+        return count
+
+    def jar_count(self, public_key, jar=''):
+        '''Return the count of an unsharded jar of public_key.'''
+        return self.count(cookiejar_address(public_key, 0, jar))
+
+    def warm(self):
+        '''Load counts from a bulk state read, up to max_size jars.
+
+           Jars changed by a block while warming keep the newer count.
+        '''
+        with self._lock:
+            generation = self._generation
+            self._warming = True
+        try:
+            for index, (address, count) in enumerate(
+                    self._client.iter_counts()):
+                if index >= self._max_size:
+                    break
+                with self._lock:
+                    # Blocks applied while warming cache every jar they
+                    # change; those counts are newer than the bulk read.
+                    if self._generation != generation and \
+                            address in self._counts:
+                        continue
+                    self._put(address, count)
+        finally:
+            with self._lock:
+                self._warming = False
+
+    def clear(self):
+        '''Drop every cached count.'''
+        with self._lock:
+            self._counts.clear()
+            self._generation += 1
+
+    def stop(self):
+        '''Close the validator stream.'''
+        self._stopped = True
+        self._stream.close()
+
+    def _put(self, address, count):
+        '''Cache count for address.  Called with the lock held.'''
+        self._counts[address] = count
+        self._counts.move_to_end(address)
+        while len(self._counts) > self._max_size:
+            self._counts.popitem(last=False)
+
+    def _subscribe(self):
+        request = client_event_pb2.ClientEventsSubscribeRequest(
+            subscriptions=[
+                events_pb2.EventSubscription(
+                    event_type="sawtooth/block-commit"),
+                events_pb2.EventSubscription(
+                    event_type="sawtooth/state-delta",
+                    filters=[events_pb2.EventFilter(
+                        key="address",
+                        match_string=NAMESPACE + ".*",
+                        filter_type=events_pb2.EventFilter.REGEX_ANY)])])
+        msg = self._stream.send(
+            message_type=Message.CLIENT_EVENTS_SUBSCRIBE_REQUEST,
+            content=request.SerializeToString()).result()
+        response = client_event_pb2.ClientEventsSubscribeResponse()
+        response.ParseFromString(msg.content)
+        if response.status != \
+                client_event_pb2.ClientEventsSubscribeResponse.OK:
+            raise Exception('Failed to subscribe to state-delta events: '
+                            '{}'.format(response.response_message))
+
+    def _receive(self):
+        while not self._stopped:
+            try:
+                msg = self._stream.receive().result()
+                if msg == RECONNECT_EVENT:
+                    # Blocks committed while disconnected are lost.
+                    self.clear()
+                    self._subscribe()
+                    continue
+                if msg.message_type != Message.CLIENT_EVENTS:
+                    continue
+                event_list = events_pb2.EventList()
+                event_list.ParseFromString(msg.content)
+                self._apply_events(event_list.events)
+            except Exception as err:
+                if not self._stopped:
+                    LOGGER.warning('Count cache receive failed: %s', err)
+
+    def _apply_events(self, events):
+        '''Apply the events of one block.'''
+        block = None
+        changes = []
+        for event in events:
+            if event.event_type == "sawtooth/block-commit":
+                block = {attribute.key: attribute.value
+                         for attribute in event.attributes}
+            elif event.event_type == "sawtooth/state-delta":
+                state_changes = transaction_receipt_pb2.StateChangeList()
+                state_changes.ParseFromString(event.data)
+                changes.extend(state_changes.state_changes)
+        if block is None:
+            return
+
+        with self._lock:
+            self._generation += 1
+            if self._head[0] is not None and \
+                    block.get('previous_block_id') != self._head[0]:
+                # A fork or a missed block: cached counts may be wrong.
+                self._counts.clear()
+            for change in changes:
+                if not change.address.startswith(NAMESPACE):
+                    continue
+                if change.type == transaction_receipt_pb2.StateChange.SET:
+                    count = decode_count(change.value)
+                else:
+                    count = None
+                if self._warming:
+                    self._put(change.address, count)
+                elif change.address in self._counts:
+                    self._counts[change.address] = count
+            self._head = (block.get('block_id'),
+                          int(block.get('block_num', 0)))
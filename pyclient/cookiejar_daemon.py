@@ -0,0 +1,140 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+A resident process that runs cookiejar CLI requests with a warm client,
+signer and REST API connection pool, behind a local Unix socket.
+
+Each connection carries one request, a JSON line such as
+    {"command": "bake", "amount": 5, "jar": ""}
+answered by one JSON line, {"output": "..."} or {"error": "..."}.
+This module imports only the standard library, so the CLI can reach a
+running daemon without paying for the client's imports.
+'''
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+# The socket sits beside the keys, as anyone who can reach it can sign
+# transactions with the daemon's key.
+DEFAULT_SOCKET = os.path.join(os.path.expanduser("~"), ".sawtooth",
+                              "cookiejar.sock")
+# Seconds to wait for a reply; bake, eat and clear wait for commit.
+DEFAULT_REQUEST_TIMEOUT = 60
+# Longest request line accepted.
+MAX_REQUEST_BYTES = 4096
+
+
+class DaemonUnavailable(Exception):
+    '''No daemon is listening on the socket; run the request in process.'''
+
+
+def request(path, message, timeout=DEFAULT_REQUEST_TIMEOUT):
+    '''Send one request to the daemon at path and return its output.
+
+       Raises DaemonUnavailable if no daemon is listening, before anything
+       was sent, so the caller can safely run the request itself.  An
+       error reported by the daemon is raised as an Exception.
+    '''
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.settimeout(timeout)
+        try:
+            connection.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError) as err:
+            raise DaemonUnavailable(str(err))
+        connection.sendall(json.dumps(message).encode() + b'\n')
+        with connection.makefile('rb') as reply_file:
+            line = reply_file.readline()
+    finally:
+        connection.close()
+    if not line:
+        raise Exception('The cookiejar daemon closed the connection')
+    reply = json.loads(line.decode())
+    if 'error' in reply:
+        raise Exception(reply['error'])
+    return reply['output']
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline(MAX_REQUEST_BYTES)
+        if not line:
+            return
+        try:
+            reply = {'output': self.server.command_handler(
+                json.loads(line.decode()))}
+        except Exception as err:
+            LOGGER.warning('Request failed: %s', err)
+            reply = {'error': str(err)}
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    '''Serves requests on a Unix socket until stopped.
+
+    'command_handler' is called with each decoded request, in a thread per
+    connection, and returns the output text; an exception it raises is
+    sent back as the error.  The socket is made accessible to its owner
+    only.  A stale socket left by a daemon that died is replaced; a live
+    one is an error.
+    '''
+
+    def __init__(self, command_handler, path=DEFAULT_SOCKET):
+        self._path = path
+        _remove_stale_socket(path)
+        old_umask = os.umask(0o177)
+        try:
+            self._server = _Server(path, _Handler)
+        finally:
+            os.umask(old_umask)
+        self._server.command_handler = command_handler
+
+    def serve_forever(self):
+        '''Serve requests until stop() is called, then remove the socket.'''
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+
+    def stop(self):
+        '''Make serve_forever() return.  Call from another thread.'''
+        threading.Thread(target=self._server.shutdown).start()
+
+
+def _remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise Exception('A cookiejar daemon is already listening on {}'
+                    .format(path))
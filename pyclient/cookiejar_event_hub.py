@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+EventHub holds one validator event subscription and fans the decoded
+events out to many local subscribers, in process or over a Unix socket.
+
+   To run, start the validator then type the following on the command line:
+       ./cookiejar_event_hub.py --socket /tmp/cookiejar-events.sock
+   A socket subscriber sends one JSON line with its filter, for example
+       {"event_types": ["cookiejar/bake"], "address": "a4d219ab.*"}
+   and then reads one JSON line per matching event.  An invalid request
+   is answered with one {"error": ...} line.
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import traceback
+
+from sawtooth_sdk.protobuf import events_pb2
+from sawtooth_sdk.protobuf import transaction_receipt_pb2
+
+from cookiejar_client import NAMESPACE
+from cookiejar_client import decode_count
+from events_client import DEFAULT_VALIDATOR_URL
+from events_client import listen_to_events
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = '/tmp/cookiejar-events.sock'
+# Events buffered per subscriber before its overflow policy applies.
+DEFAULT_MAX_BUFFER = 10000
+OVERFLOW_POLICIES = ('disconnect', 'drop-oldest')
+
+
+def decode_events(events):
+    '''Return one dictionary per event of a block, for JSON encoding.
+
+       Every dictionary has the block's block_id and block_num and the
+       event_type.  Attributes are a dictionary; bake and eat events also
+       get the jar 'address'.  A state-delta event becomes one dictionary
+       per cookiejar address changed, with its new 'count' (None when the
+       address was deleted).
+    '''
+    block = {}
+    for event in events:
+        if event.event_type == "sawtooth/block-commit":
+            block = {attribute.key: attribute.value
+                     for attribute in event.attributes}
+    block_id = block.get('block_id')
+    block_num = int(block['block_num']) if 'block_num' in block else None
+
+    decoded = []
+    for event in events:
+        if event.event_type == "sawtooth/state-delta":
+            state_changes = transaction_receipt_pb2.StateChangeList()
+            state_changes.ParseFromString(event.data)
+            for change in state_changes.state_changes:
+                if not change.address.startswith(NAMESPACE):
+                    continue
+                decoded.append({
+                    'block_id': block_id,
+                    'block_num': block_num,
+                    'event_type': event.event_type,
+                    'address': change.address,
+                    'count': decode_count(change.value)
+                             if change.type ==
+                             transaction_receipt_pb2.StateChange.SET
+                             else None})
+            continue
+        attributes = {attribute.key: attribute.value
+                      for attribute in event.attributes}
+        message = {'block_id': block_id,
+                   'block_num': block_num,
+                   'event_type': event.event_type,
+                   'attributes': attributes}
+        if 'address' in attributes:
+            message['address'] = attributes['address']
+        decoded.append(message)
+    return decoded
+
+
+class Subscription(object):
+    '''One subscriber's filter and bounded buffer of decoded events.
+
+    Events pass the filter if their type is in event_types (any type if
+    None) and, with address_regex, if they have an address that matches.
+    When max_buffer events are waiting, the subscriber falls under its
+    overflow policy: 'disconnect' closes the subscription, so it can
+    resynchronize, and 'drop-oldest' discards the oldest waiting event.
+    'dropped' counts discarded events.
+    '''
+
+    def __init__(self, hub, event_types=None, address_regex=None,
+                 max_buffer=DEFAULT_MAX_BUFFER, overflow='disconnect'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise Exception('Unknown overflow policy: {}'.format(overflow))
+        if max_buffer < 1:
+            raise Exception('max_buffer must be at least 1')
+        self._hub = hub
+        self._event_types = None if event_types is None \
+            else frozenset(event_types)
+        self._address = None if address_regex is None \
+            else re.compile(address_regex)
+        self._overflow = overflow
+        self._queue = asyncio.Queue(max_buffer)
+        self.closed = False
+        self.dropped = 0
+
+    def matches(self, message):
+        '''Return True if message passes this subscription's filter.'''
+        if self._event_types is not None and \
+                message['event_type'] not in self._event_types:
+            return False
+        if self._address is not None:
+            address = message.get('address')
+            return address is not None and \
+                self._address.match(address) is not None
+        return True
+
+    async def get(self):
+        '''Return the next event, or None once the subscription closed.'''
+        if self.closed and self._queue.empty():
+            return None
+        return await self._queue.get()
+
+    def close(self):
+        '''Stop receiving events.'''
+        if not self.closed:
+            self.closed = True
+            self._hub._subscriptions.discard(self)
+            # Wake a reader waiting in get().
+            if self._queue.full():
+                self._queue.get_nowait()
+            self._queue.put_nowait(None)
+
+    def _offer(self, message):
+        if self._queue.full():
+            if self._overflow == 'disconnect':
+                LOGGER.warning('Disconnecting a subscriber %s events behind',
+                               self._queue.qsize())
+                self.dropped += self._queue.qsize()
+                self.close()
+                return
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(message)
+
+
+class EventHub(object):
+    '''Fans one validator event subscription out to local subscribers.
+
+    The validator stream is read by listen_to_events() in a daemon
+    thread, which resubscribes after disconnects without losing or
+    repeating blocks.  Each block's events are decoded once and offered
+    to every subscription on the event loop.
+    '''
+
+    def __init__(self, validator_url=DEFAULT_VALIDATOR_URL, state_file=None,
+                 loop=None):
+        self._validator_url = validator_url
+        self._state_file = state_file
+        self._loop = asyncio.get_event_loop() if loop is None else loop
+        self._subscriptions = set()
+
+    def subscribe(self, event_types=None, address_regex=None,
+                  max_buffer=DEFAULT_MAX_BUFFER, overflow='disconnect'):
+        '''Return a new in-process Subscription; see Subscription.'''
+        subscription = Subscription(self, event_types, address_regex,
+                                    max_buffer, overflow)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def publish(self, messages):
+        '''Offer decoded events to every matching subscription.
+
+           Must be called on the hub's event loop.
+        '''
+        for subscription in list(self._subscriptions):
+            for message in messages:
+                if subscription.closed:
+                    break
+                if subscription.matches(message):
+                    subscription._offer(message)
+
+    def run_in_thread(self):
+        '''Start reading the validator stream in a daemon thread.
+
+           Returns a future that finishes if the stream does.  The thread
+           blocks on the stream, so it is a daemon and does not keep the
+           process alive at exit.
+        '''
+        future = self._loop.create_future()
+        thread = threading.Thread(target=self._listen, args=(future,),
+                                  name='cookiejar-event-hub', daemon=True)
+        thread.start()
+        return future
+
+    async def serve_unix(self, path=DEFAULT_SOCKET):
+        '''Serve subscribers on a Unix socket at path.'''
+        if os.path.exists(path):
+            os.unlink(path)
+        return await asyncio.start_unix_server(self._serve_client, path)
+
+    def _listen(self, future):
+        filters = [events_pb2.EventFilter(
+            key="address", match_string=NAMESPACE + ".*",
+            filter_type=events_pb2.EventFilter.REGEX_ANY)]
+        try:
+            result = listen_to_events(
+                delta_filters=filters, handler=self._on_block,
+                state_file=self._state_file,
+                validator_url=self._validator_url)
+        except BaseException as err:
+            self._finish(future, future.set_exception, err)
+        else:
+            self._finish(future, future.set_result, result)
+
+    def _finish(self, future, setter, value):
+        def finish():
+            if not future.done():
+                setter(value)
+        try:
+            self._loop.call_soon_threadsafe(finish)
+        except RuntimeError:
+            # The loop closed first; nobody is waiting for the result.
+            pass
+
+    def _on_block(self, events):
+        # Called in the stream thread; decode there, publish on the loop.
+        self._loop.call_soon_threadsafe(self.publish, decode_events(events))
+
+    async def _serve_client(self, reader, writer):
+        subscription = None
+        try:
+            line = await reader.readline()
+            try:
+                subscription = self.subscribe(*_parse_request(line))
+            except ValueError as err:
+                LOGGER.info('Rejected a subscriber: %s', err)
+                writer.write(json.dumps({'error': str(err)}).encode() +
+                             b'\n')
+                await writer.drain()
+                return
+            while True:
+                message = await subscription.get()
+                if message is None:
+                    break
+                writer.write(json.dumps(message).encode() + b'\n')
+                # Waits while the subscriber's socket is full; the
+                # subscription's buffer absorbs events meanwhile.
+                await writer.drain()
+        except (ConnectionError, ValueError) as err:
+            LOGGER.info('Subscriber left: %s', err)
+        finally:
+            if subscription is not None:
+                subscription.close()
+            writer.close()
+
+
+def _parse_request(line):
+    '''Return the subscribe() arguments of a socket subscriber's request.
+
+       Raises ValueError if the request is not valid.
+    '''
+    try:
+        request = json.loads(line.decode() or '{}')
+    except ValueError:
+        raise ValueError('Request must be a JSON object')
+    if not isinstance(request, dict):
+        raise ValueError('Request must be a JSON object')
+    event_types = request.get('event_types')
+    if event_types is not None and (
+            not isinstance(event_types, list) or
+            not all(isinstance(event_type, str)
+                    for event_type in event_types)):
+        raise ValueError('event_types must be a list of strings')
+    address = request.get('address')
+    if address is not None:
+        if not isinstance(address, str):
+            raise ValueError('address must be a string')
+        try:
+            re.compile(address)
+        except re.error as err:
+            raise ValueError('Invalid address pattern: {}'.format(err))
+    max_buffer = request.get('max_buffer', DEFAULT_MAX_BUFFER)
+    if not isinstance(max_buffer, int) or isinstance(max_buffer, bool) or \
+            max_buffer < 1:
+        raise ValueError('max_buffer must be a positive integer')
+    overflow = request.get('overflow', 'disconnect')
+    if overflow not in OVERFLOW_POLICIES:
+        raise ValueError('overflow must be one of {}'.format(
+            ', '.join(OVERFLOW_POLICIES)))
+    return (event_types, address, min(max_buffer, DEFAULT_MAX_BUFFER),
+            overflow)
+
+
+def create_parser(prog_name):
+    '''Create the command line argument parser for the event hub.'''
+    parser = argparse.ArgumentParser(
+        prog=prog_name,
+        description='Fans cookiejar events out to local subscribers')
+    parser.add_argument('--url', default=DEFAULT_VALIDATOR_URL,
+                        help='validator URL (default %(default)s)')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help='Unix socket to serve (default %(default)s)')
+    parser.add_argument('--state-file',
+                        help='file recording the last blocks handled, to '
+                        'resume from after a restart')
+    return parser
+
+
+def main(prog_name=os.path.basename(sys.argv[0]), args=None):
+    '''Entry point function for the event hub.'''
+    try:
+        if args is None:
+            args = sys.argv[1:]
+        args = create_parser(prog_name).parse_args(args)
+        logging.basicConfig()
+
+        loop = asyncio.get_event_loop()
+        hub = EventHub(args.url, args.state_file, loop)
+        server = loop.run_until_complete(hub.serve_unix(args.socket))
+        try:
+            loop.run_until_complete(hub.run_in_thread())
+        finally:
+            server.close()
+    except KeyboardInterrupt:
+        pass
+    except SystemExit as err:
+        raise err
+    except BaseException as err:
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
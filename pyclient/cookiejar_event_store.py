@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+Ingests cookiejar events into a local SQLite database for history queries,
+such as bakes per jar per hour, without replaying the chain.
+
+   To run, start the validator then type the following on the command line:
+       ./cookiejar_event_store.py --db events.db
+   and, while it runs or afterwards:
+       ./cookiejar_event_store.py --db events.db --report
+'''
+
+import argparse
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+from sawtooth_sdk.protobuf import events_pb2
+from sawtooth_sdk.protobuf import transaction_receipt_pb2
+
+from cookiejar_client import NAMESPACE
+from cookiejar_client import decode_count
+from events_client import DEFAULT_VALIDATOR_URL
+from events_client import RECENT_BLOCKS
+from events_client import listen_to_events
+
+LOGGER = logging.getLogger(__name__)
+
+# Blocks held between the receive loop and the writer.  When the writer
+# falls behind, the receive loop blocks and the validator buffers events.
+DEFAULT_QUEUE_SIZE = 1000
+# Rows per SQLite transaction, and the longest a row waits to be written.
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+# 'received' is the time the block's events reached the ingester, as the
+# block-commit event carries no timestamp.  'amount' is set for bake and
+# eat events, 'count' (the new jar count, NULL when deleted) for
+# state-delta rows.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blocks (
+    block_id TEXT PRIMARY KEY,
+    block_num INTEGER NOT NULL,
+    received REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    block_id TEXT NOT NULL,
+    block_num INTEGER NOT NULL,
+    event_type TEXT NOT NULL,
+    address TEXT,
+    amount INTEGER,
+    count INTEGER,
+    received REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blocks_block_num ON blocks (block_num);
+CREATE INDEX IF NOT EXISTS events_address ON events (address, block_num);
+CREATE INDEX IF NOT EXISTS events_block_num ON events (block_num);
+CREATE INDEX IF NOT EXISTS events_event_type ON events (event_type, received);
+'''
+
+BAKES_PER_JAR_PER_HOUR = '''
+SELECT address, CAST(received / 3600 AS INTEGER) * 3600 AS hour,
+       COUNT(*) AS bakes, SUM(amount) AS cookies
+FROM events
+WHERE event_type = 'cookiejar/bake' AND received >= ?
+GROUP BY address, hour
+ORDER BY hour, address
+'''
+
+
+def connect(path):
+    '''Open the event database at path, creating the schema if needed.'''
+    connection = sqlite3.connect(path, check_same_thread=False)
+    # WAL lets queries run while the writer commits.
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def decode_block(events, received=None):
+    '''Return (block, rows) for the events of one block.
+
+       'block' is (block_id, block_num, received), or None without a
+       block-commit event.  'rows' are tuples for the events table, minus
+       the block columns: (event_type, address, amount, count).
+    '''
+    if received is None:
+        received = time.time()
+    block = None
+    rows = []
+    for event in events:
+        attributes = {attribute.key: attribute.value
+                      for attribute in event.attributes}
+        if event.event_type == "sawtooth/block-commit":
+            block = (attributes['block_id'], int(attributes['block_num']),
+                     received)
+        elif event.event_type == "cookiejar/bake":
+            rows.append((event.event_type, attributes.get('address'),
+                         int(attributes['cookies-baked']), None))
+        elif event.event_type == "cookiejar/eat":
+            rows.append((event.event_type, attributes.get('address'),
+                         int(attributes['cookies-ate']), None))
+        elif event.event_type == "sawtooth/state-delta":
+            state_changes = transaction_receipt_pb2.StateChangeList()
+            state_changes.ParseFromString(event.data)
+            for change in state_changes.state_changes:
+                if not change.address.startswith(NAMESPACE):
+                    continue
+                count = decode_count(change.value) \
+                    if change.type == transaction_receipt_pb2.StateChange.SET \
+                    else None
+                rows.append((event.event_type, change.address, None, count))
+    return block, rows
+
+
+class EventIngester(object):
+    '''Writes cookiejar events into an SQLite database.
+
+    The validator receive loop decodes nothing; it only puts each block's
+    events on a bounded queue.  A writer thread decodes them and commits
+    rows in batches of up to batch_size, at least every flush_interval
+    seconds.  Each block is committed with its events, and the stream
+    resumes after the newest committed block, so a restart neither loses
+    nor duplicates events.  If decoding or writing a block fails, the
+    ingester stops: put(), run() and close() raise the error, and the
+    blocks not written are received again after a restart.
+    '''
+
+    def __init__(self, path, queue_size=DEFAULT_QUEUE_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self._connection = connect(path)
+        self._queue = queue.Queue(queue_size)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        # The error that stopped the writer, if any.
+        self._error = None
+        self._writer = threading.Thread(target=self._write,
+                                        name='EventIngesterWriter')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def last_block_ids(self):
+        '''Return the IDs of the newest committed blocks, newest first.'''
+        return [block_id for block_id, in self._connection.execute(
+            'SELECT block_id FROM blocks ORDER BY block_num DESC LIMIT ?',
+            (RECENT_BLOCKS,))]
+
+    def run(self, validator_url=DEFAULT_VALIDATOR_URL):
+        '''Subscribe to cookiejar events and ingest them until interrupted.'''
+        filters = [events_pb2.EventFilter(
+            key="address", match_string=NAMESPACE + ".*",
+            filter_type=events_pb2.EventFilter.REGEX_ANY)]
+        try:
+            listen_to_events(delta_filters=filters, handler=self.put,
+                             validator_url=validator_url,
+                             last_known_block_ids=self.last_block_ids())
+        finally:
+            self.close()
+
+    def put(self, events):
+        '''Queue the events of one block, blocking while the queue is full.'''
+        if self._error is not None:
+            raise self._error
+        self._queue.put((list(events), time.time()))
+
+    def close(self):
+        '''Write everything queued, then close the database.'''
+        self._queue.put(None)
+        self._writer.join()
+        self._connection.close()
+        if self._error is not None:
+            raise self._error
+
+    def _write(self):
+        pending = []
+        rows = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None \
+                else max(deadline - time.time(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if item and self._error is not None:
+                # Keep draining, so put() does not block, until close().
+                continue
+            try:
+                if item:
+                    events, received = item
+                    block, block_rows = decode_block(events, received)
+                    pending.append((block, block_rows))
+                    rows += len(block_rows) + 1
+                    if deadline is None:
+                        deadline = time.time() + self._flush_interval
+                if pending and (item is None or rows >= self._batch_size or
+                                time.time() >= deadline):
+                    self._commit(pending)
+                    pending = []
+                    rows = 0
+                    deadline = None
+            except Exception as err:
+                # A failed commit was rolled back.  Stop rather than skip
+                # these blocks; a restart receives them again.
+                LOGGER.error('Failed to write events: %s', err)
+                self._error = err
+                pending = []
+                rows = 0
+                deadline = None
+            if item is None:
+                return
+
+    def _commit(self, blocks):
+        '''Write decoded blocks in one transaction.'''
+        with self._connection:
+            for block, rows in blocks:
+                if block is None:
+                    continue
+                cursor = self._connection.execute(
+                    'INSERT OR IGNORE INTO blocks VALUES (?, ?, ?)', block)
+                if cursor.rowcount == 0:
+                    # Already ingested before a restart.
+                    continue
+                block_id, block_num, received = block
+                self._connection.executemany(
+                    'INSERT INTO events (block_id, block_num, event_type, '
+                    'address, amount, count, received) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(block_id, block_num) + row + (received,)
+                     for row in rows])
+
+
+def bakes_per_jar_per_hour(path, since=0):
+    '''Return rows of (address, hour, bakes, cookies) since a Unix time.'''
+    connection = connect(path)
+    try:
+        return connection.execute(BAKES_PER_JAR_PER_HOUR, (since,)).fetchall()
+    finally:
+        connection.close()
+
+
+def create_parser(prog_name):
+    '''Create the command line argument parser for the event store.'''
+    parser = argparse.ArgumentParser(
+        prog=prog_name,
+        description='Stores cookiejar events in an SQLite database')
+    parser.add_argument('--db', default='cookiejar_events.db',
+                        help='SQLite database file (default %(default)s)')
+    parser.add_argument('--url', default=DEFAULT_VALIDATOR_URL,
+                        help='validator URL (default %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='rows per database transaction')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='blocks buffered ahead of the writer')
+    parser.add_argument('--report', action='store_true',
+                        help='print bakes per jar per hour as JSON and exit')
+    parser.add_argument('--since', type=float, default=0,
+                        help='Unix time the report starts from')
+    return parser
+
+
+def main(prog_name=os.path.basename(sys.argv[0]), args=None):
+    '''Entry point function for the event store.'''
+    try:
+        if args is None:
+            args = sys.argv[1:]
+        args = create_parser(prog_name).parse_args(args)
+        logging.basicConfig()
+
+        if args.report:
+            print(json.dumps(
+                [dict(zip(('address', 'hour', 'bakes', 'cookies'), row))
+                 for row in bakes_per_jar_per_hour(args.db, args.since)],
+                indent=2))
+            return
+        EventIngester(args.db, queue_size=args.queue_size,
+                      batch_size=args.batch_size).run(args.url)
+    except KeyboardInterrupt:
+        pass
+    except SystemExit as err:
+        raise err
+    except BaseException as err:
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
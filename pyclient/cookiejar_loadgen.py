@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+Load generator and throughput benchmark for the cookiejar TF.
+
+Drives a mix of bake/eat/count/clear operations across many keys through
+CookieJarClient at a target rate, in open- or closed-loop mode, and
+reports submit latency, commit latency percentiles and achieved TPS.
+With --local it runs against an in-process stand-in for the REST API, so
+no validator is needed.
+'''
+
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+from sawtooth_signing import create_context
+from sawtooth_sdk.protobuf.batch_pb2 import BatchList
+from sawtooth_sdk.protobuf.transaction_pb2 import TransactionHeader
+
+from cookiejar_client import CookieJarClient
+from cookiejar_client import _batch_ids
+from cookiejar_client import cookiejar_address
+from cookiejar_client import create_rest_session
+from cookiejar_client import create_signer
+from cookiejar_client import decode_operations
+from cookiejar_client import encode_count
+from cookiejar_status import BatchStatusTracker
+
+DEFAULT_URL = 'http://rest-api:8008'
+DEFAULT_MIX = 'bake=50,eat=30,count=15,clear=5'
+ACTIONS = ('bake', 'eat', 'count', 'clear')
+PERCENTILES = (50, 90, 99)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class LocalRestApi(object):
+    '''In-process stand-in for the Sawtooth REST API.
+
+    Implements just enough of POST /batches, GET and POST /batch_statuses,
+    GET /state/<address> and GET /state for CookieJarClient.  Batches are
+    applied to an in-memory state as they arrive and are immediately
+    COMMITTED, or INVALID if any transaction would eat more cookies than
+    the jar holds.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._lock = threading.Lock()
+        # address -> (count, family version of the last write)
+        self._state = {}
+        self._statuses = {}
+        api = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                api._handle(self, None)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                api._handle(self, self.rfile.read(length))
+
+        self._server = _ThreadingHTTPServer((host, port), _Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='LocalRestApi')
+        self._thread.daemon = True
+
+    @property
+    def url(self):
+        '''Return the base URL to pass to CookieJarClient.'''
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        '''Serve requests in a background thread.'''
+        self._thread.start()
+
+    def stop(self):
+        '''Stop serving requests.'''
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handle(self, request, body):
+        url = urlparse(request.path)
+        try:
+            if url.path == '/batches' and body is not None:
+                status, reply = 202, self._submit(body)
+            elif url.path == '/batch_statuses':
+                if body is not None:
+                    batch_ids = json.loads(body.decode())
+                else:
+                    batch_ids = parse_qs(url.query)['id'][0].split(',')
+                status, reply = 200, self._batch_statuses(batch_ids)
+            elif url.path.startswith('/state/'):
+                status, reply = self._get_state(url.path[len('/state/'):])
+            elif url.path == '/state':
+                status, reply = 200, self._list_state(
+                    request.headers.get('Host'),
+                    {key: values[0]
+                     for key, values in parse_qs(url.query).items()})
+            else:
+                status, reply = 404, {'error': {'title': 'Not Found'}}
+        except Exception as err:
+            status, reply = 400, {'error': {'title': str(err)}}
+
+        data = json.dumps(reply).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def _submit(self, body):
+        batch_list = BatchList()
+        batch_list.ParseFromString(body)
+        with self._lock:
+            for batch in batch_list.batches:
+                self._statuses[batch.header_signature] = \
+                    self._apply_batch(batch)
+        return {'link': '/batch_statuses?id={}'.format(
+            ','.join(_batch_ids(batch_list)))}
+
+    def _apply_batch(self, batch):
+        '''Apply a batch atomically.  Called with the lock held.'''
+        changes = {}
+        for transaction in batch.transactions:
+            header = TransactionHeader()
+            header.ParseFromString(transaction.header)
+            public_key = header.signer_public_key
+            jar = ''
+            address = cookiejar_address(public_key)
+            for action, amount in decode_operations(transaction.payload,
+                                                    header.family_version):
+                if action == 'jar':
+                    jar = amount
+                    address = cookiejar_address(public_key, 0, jar)
+                    continue
+                if action == 'shard':
+                    address = cookiejar_address(public_key, amount, jar)
+                    continue
+                count, _ = changes.get(address,
+                                       self._state.get(address, (0, None)))
+                if action == 'bake':
+                    count += amount
+                elif action == 'eat':
+                    if count < amount:
+                        return 'INVALID'
+                    count -= amount
+                elif action == 'clear':
+                    count = 0
+                changes[address] = (count, header.family_version)
+        self._state.update(changes)
+        return 'COMMITTED'
+
+    def _batch_statuses(self, batch_ids):
+        with self._lock:
+            return {'data': [
+                {'id': batch_id,
+                 'status': self._statuses.get(batch_id, 'UNKNOWN'),
+                 'invalid_transactions': []}
+                for batch_id in batch_ids]}
+
+    def _get_state(self, address):
+        with self._lock:
+            if address not in self._state:
+                return 404, {'error': {'title': 'State Not Found'}}
+            data = encode_count(*self._state[address])
+        return 200, {'data': base64.b64encode(data).decode()}
+
+    def _list_state(self, host, query):
+        '''Return one page of state entries, paged by address.'''
+        prefix = query.get('address', '')
+        start = query.get('start', '')
+        limit = int(query.get('limit', 100))
+        with self._lock:
+            addresses = sorted(address for address in self._state
+                               if address.startswith(prefix) and
+                               address >= start)
+            entries = [{'address': address,
+                        'data': base64.b64encode(
+                            encode_count(*self._state[address])).decode()}
+                       for address in addresses[:limit]]
+        paging = {'start': start, 'limit': limit}
+        if len(addresses) > limit:
+            paging['next_position'] = addresses[limit]
+            paging['next'] = 'http://{}/state?head=local&start={}' \
+                '&limit={}&address={}'.format(host, addresses[limit], limit,
+                                              prefix)
+        return {'data': entries, 'head': 'local', 'paging': paging}
+
+
+def _parse_mix(mix):
+    '''Parse "bake=50,eat=30" into a list of (action, weight).'''
+    weights = []
+    for item in mix.split(','):
+        action, _, weight = item.partition('=')
+        if action not in ACTIONS:
+            raise Exception('Unknown action in mix: {}'.format(action))
+        weights.append((action, float(weight or 1)))
+    return weights
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _summarize(latencies):
+    values = sorted(latencies)
+    summary = {'count': len(values)}
+    if values:
+        summary['mean'] = sum(values) / len(values)
+        summary['max'] = values[-1]
+        for percent in PERCENTILES:
+            summary['p{}'.format(percent)] = _percentile(values, percent)
+    return summary
+
+
+class LoadGenerator(object):
+    '''Drives a weighted mix of cookie jar operations and records timing.
+
+    In closed-loop mode each of 'concurrency' workers issues its next
+    operation as soon as the previous one finishes.  In open-loop mode
+    operations start at 'rate' per second regardless of how long earlier
+    ones take, and latency is measured from each operation's scheduled
+    start, so a slow server shows up as queueing rather than lower load.
+    '''
+
+    def __init__(self, clients, mix, wait=10, max_amount=10, seed=None):
+        self._clients = clients
+        self._actions = [action for action, _ in mix]
+        self._weights = [weight for _, weight in mix]
+        self._wait = wait
+        self._max_amount = max_amount
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._results = []
+
+    def run_closed(self, concurrency, duration=None, operations=None):
+        '''Run closed-loop until duration seconds or operations are done.'''
+        deadline = None if duration is None else time.time() + duration
+        remaining = [operations]
+
+        def _take():
+            with self._lock:
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                if remaining[0] is not None:
+                    if remaining[0] <= 0:
+                        return False
+                    remaining[0] -= 1
+                return True
+
+        def _worker():
+            while _take():
+                self._run_one(time.time())
+
+        start = time.time()
+        threads = [threading.Thread(target=_worker)
+                   for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self._report('closed', time.time() - start)
+
+    def run_open(self, rate, concurrency, duration=None, operations=None):
+        '''Run open-loop at rate operations per second.'''
+        if operations is None:
+            operations = int(rate * duration)
+        interval = 1.0 / rate
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for index in range(operations):
+                scheduled = start + index * interval
+                delay = scheduled - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self._run_one, scheduled)
+        return self._report('open', time.time() - start)
+
+    def _run_one(self, scheduled):
+        with self._lock:
+            action = self._weighted_choice()
+            client = self._random.choice(self._clients)
+            amount = self._random.randint(1, self._max_amount)
+
+        result = {'action': action}
+        try:
+            if action == 'count':
+                client.count()
+                result['submit'] = time.time() - scheduled
+                result['status'] = 'OK'
+            else:
+                if action == 'clear':
+                    amount = 0
+                if action == 'eat' and client._shards > 1:
+                    # Eats must span every shard, as eat() does.
+                    transaction = client._create_sharded_eat(amount)
+                else:
+                    transaction = client._create_transaction(action, amount)
+                batch_list = BatchList(batches=[client._create_batch(
+                    [transaction])])
+                client._send_batch_list(batch_list)
+                result['submit'] = time.time() - scheduled
+                status = client._wait_for_batches(
+                    _batch_ids(batch_list), self._wait, None)
+                try:
+                    result['status'] = json.loads(status)['data'][0]['status']
+                except (TypeError, ValueError):
+                    result['status'] = 'TIMEOUT'
+                if result['status'] == 'COMMITTED':
+                    result['commit'] = time.time() - scheduled
+        except Exception as err:
+            result['status'] = 'ERROR'
+            result['error'] = str(err)
+
+        with self._lock:
+            self._results.append(result)
+
+    def _weighted_choice(self):
+        point = self._random.uniform(0, sum(self._weights))
+        for action, weight in zip(self._actions, self._weights):
+            point -= weight
+            if point <= 0:
+                return action
+        return self._actions[-1]
+
+    def _report(self, mode, elapsed):
+        with self._lock:
+            results = self._results
+            self._results = []
+
+        report = {'mode': mode, 'elapsed': elapsed,
+                  'operations': len(results), 'actions': {}}
+        completed = 0
+        for action in self._actions:
+            action_results = [result for result in results
+                              if result['action'] == action]
+            statuses = {}
+            for result in action_results:
+                statuses[result['status']] = \
+                    statuses.get(result['status'], 0) + 1
+            completed += statuses.get('COMMITTED', 0) + \
+                statuses.get('OK', 0)
+            report['actions'][action] = {
+                'statuses': statuses,
+                'submit_latency': _summarize(
+                    [result['submit'] for result in action_results
+                     if 'submit' in result]),
+                'commit_latency': _summarize(
+                    [result['commit'] for result in action_results
+                     if 'commit' in result]),
+            }
+        report['tps'] = completed / elapsed if elapsed > 0 else 0.0
+        return report
+
+
+def create_parser(prog_name):
+    '''Create the command line argument parser for the load generator.'''
+    parser = argparse.ArgumentParser(
+        prog=prog_name,
+        description='Generates cookiejar load and reports throughput')
+    parser.add_argument('--url', default=DEFAULT_URL,
+                        help='REST API URL (default %(default)s)')
+    parser.add_argument('--local', action='store_true',
+                        help='run against an in-process stand-in REST API')
+    parser.add_argument('--keys', type=int, default=10,
+                        help='number of signing keys (cookie jars)')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='shards per cookie jar')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weighted operation mix (default %(default)s)')
+    parser.add_argument('--mode', choices=['open', 'closed'],
+                        default='closed', help='open or closed loop')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='target operations per second (open loop)')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='operations in flight at once')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to run')
+    parser.add_argument('--operations', type=int,
+                        help='number of operations, instead of --duration')
+    parser.add_argument('--wait', type=float, default=10,
+                        help='seconds to wait for each commit')
+    parser.add_argument('--bulk-status', action='store_true',
+                        help='resolve commits with one bulk status tracker')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('--output', help='write the JSON report to a file')
+    return parser
+
+
+def main(prog_name=os.path.basename(sys.argv[0]), args=None):
+    '''Entry point function for the load generator.'''
+    try:
+        if args is None:
+            args = sys.argv[1:]
+        args = create_parser(prog_name).parse_args(args)
+
+        local_api = None
+        url = args.url
+        if args.local:
+            local_api = LocalRestApi()
+            local_api.start()
+            url = local_api.url
+
+        session = create_rest_session(pool_size=args.concurrency)
+        context = create_context('secp256k1')
+        clients = [CookieJarClient(url, session=session,
+                                   signer=create_signer(
+                                       context.new_random_private_key()
+                                       .as_hex()),
+                                   shards=args.shards)
+                   for _ in range(args.keys)]
+        tracker = None
+        if args.bulk_status:
+            tracker = BatchStatusTracker(clients[0])
+            for client in clients:
+                client.set_status_tracker(tracker)
+
+        generator = LoadGenerator(clients, _parse_mix(args.mix),
+                                  wait=args.wait, seed=args.seed)
+        duration = None if args.operations is not None else args.duration
+        if args.mode == 'open':
+            report = generator.run_open(args.rate, args.concurrency,
+                                        duration, args.operations)
+        else:
+            report = generator.run_closed(args.concurrency, duration,
+                                          args.operations)
+        report['url'] = url
+        report['keys'] = args.keys
+        report['shards'] = args.shards
+        report['concurrency'] = args.concurrency
+        if args.mode == 'open':
+            report['target_rate'] = args.rate
+
+        if tracker is not None:
+            tracker.stop()
+        if local_api is not None:
+            local_api.stop()
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as output_fd:
+                output_fd.write(output + '\n')
+        print(output)
+    except KeyboardInterrupt:
+        pass
+    except SystemExit as err:
+        raise err
+    except BaseException as err:
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+Client-side latency metrics and tracing spans for CookieJarClient, broken
+down by phase: payload build, header serialization, signing, batching,
+HTTP submit and time to commit.
+'''
+
+import bisect
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# The phases CookieJarClient records, in the order a submission goes
+# through them.
+PHASES = ('payload', 'header', 'sign', 'batch', 'submit', 'commit')
+
+# Upper bounds, in seconds, of the latency buckets.
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Span(object):
+    '''One timed phase: its name, start (Unix time), duration in seconds
+       and attributes such as the batch IDs involved.
+    '''
+    __slots__ = ('name', 'start', 'duration', 'attributes')
+
+    def __init__(self, name, start, duration, attributes):
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.attributes = attributes
+
+    def __repr__(self):
+        return 'Span({!r}, duration={:.6f}, {!r})'.format(
+            self.name, self.duration, self.attributes)
+
+
+class InMemoryExporter(object):
+    '''Keeps exported spans in a list, for tests and ad hoc analysis.'''
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+
+class LoggingExporter(object):
+    '''Logs each span at DEBUG level.'''
+
+    def export(self, span):
+        LOGGER.debug('span %s %.6fs %s', span.name, span.duration,
+                     span.attributes)
+
+
+class _Histogram(object):
+    def __init__(self, buckets):
+        self._buckets = buckets
+        # One more than the buckets, for observations above them all.
+        self._counts = [0] * (len(buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._count += 1
+        self._sum += value
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self._buckets, self._counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'count': self._count, 'sum': self._sum,
+                'mean': self._sum / self._count if self._count else None}
+
+
+class _Timer(object):
+    __slots__ = ('_metrics', '_name', '_attributes', '_start')
+
+    def __init__(self, metrics, name, attributes):
+        self._metrics = metrics
+        self._name = name
+        self._attributes = attributes
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, trace):
+        self._metrics.observe(self._name, time.perf_counter() - self._start,
+                              self._attributes)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, trace):
+        pass
+
+# Returned by CookieJarClient when no metrics are attached.
+NULL_TIMER = _NullTimer()
+
+
+class ClientMetrics(object):
+    '''Per-phase latency histograms, with optional span export.
+
+    Attach to a client with CookieJarClient(..., metrics=...) or
+    set_metrics().  Each phase listed in PHASES gets a histogram; with an
+    'exporter' (any object with an export(span) method, such as
+    InMemoryExporter), every timed phase is also exported as a Span.
+    '''
+
+    def __init__(self, exporter=None, buckets=LATENCY_BUCKETS):
+        self._exporter = exporter
+        self._buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def span(self, name, **attributes):
+        '''Return a context manager timing the phase 'name'.'''
+        return _Timer(self, name, attributes)
+
+    def observe(self, name, seconds, attributes=None):
+        '''Record that phase 'name' took 'seconds'.'''
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = \
+                    _Histogram(self._buckets)
+            histogram.observe(seconds)
+        if self._exporter is not None:
+            self._exporter.export(Span(name, time.time() - seconds, seconds,
+                                       attributes or {}))
+
+    def snapshot(self):
+        '''Return a dictionary of phase name to histogram values.'''
+        with self._lock:
+            return {name: histogram.snapshot()
+                    for name, histogram in self._histograms.items()}
@@ -0,0 +1,160 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+SigningPipeline signs cookie jar transactions and batches across a pool of
+worker processes, for bulk loads where secp256k1 signing is the bottleneck.
+'''
+
+import collections
+import itertools
+import multiprocessing
+
+from sawtooth_sdk.protobuf.batch_pb2 import Batch
+
+from cookiejar_client import CookieJarClient
+from cookiejar_client import FAMILY_VERSION
+from cookiejar_client import MAX_BATCHES_PER_BATCH_LIST
+from cookiejar_client import MAX_BATCH_LIST_BYTES
+from cookiejar_client import MAX_TRANSACTIONS_PER_BATCH
+from cookiejar_client import _batch_ids
+from cookiejar_client import _random_nonce
+from cookiejar_client import create_signer
+from cookiejar_client import pack_batch_lists
+from cookiejar_client import read_private_key
+
+# Batches queued per worker before sign() stops reading operations.
+IN_FLIGHT_PER_WORKER = 4
+
+# The signing client of each worker process, set up by _init_worker.
+_worker_client = None
+
+
+def _init_worker(private_key_str, family_version, jar=''):
+    global _worker_client
+    _worker_client = CookieJarClient(None,
+                                     signer=create_signer(private_key_str),
+                                     family_version=family_version, jar=jar)
+
+
+def _sign_batch(operations):
+    '''Sign one batch in a worker.
+
+       'operations' is a list of (args, nonce) pairs, where args are the
+       positional arguments of CookieJarClient._create_transaction.
+       Returns the serialized Batch; signer objects do not pickle.
+    '''
+    transactions = [_worker_client._create_transaction(*args, nonce=nonce)
+                    for args, nonce in operations]
+    return _worker_client._create_batch(transactions).SerializeToString()
+
+
+class SigningPipeline(object):
+    '''Signs transactions and batches in a pool of worker processes.
+
+    Operations are tuples such as ("bake", 5), grouped into batches of
+    transactions_per_batch.  Nonces are drawn from nonce_source in this
+    process, in operation order, and secp256k1 signatures are
+    deterministic, so the output is byte-identical to signing the same
+    operations serially with CookieJarClient and the same nonce source.
+    Signed batches are yielded in order as soon as they are ready, while
+    later batches are still being signed.
+    '''
+
+    def __init__(self, private_key_str, workers=None,
+                 transactions_per_batch=MAX_TRANSACTIONS_PER_BATCH,
+                 nonce_source=None, family_version=FAMILY_VERSION, jar=''):
+        '''Start the worker processes.
+
+           'workers' defaults to the number of CPUs; 0 signs in this
+           process, which is handy for comparing against the pool.
+           'jar' names the jar the operations act on.
+        '''
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self._workers = workers
+        self._transactions_per_batch = transactions_per_batch
+        self._nonce_source = _random_nonce if nonce_source is None \
+            else nonce_source
+        # Set up the signing client here first, so a bad key, jar or
+        # family version raises now rather than in each worker, which the
+        # pool would restart forever.  With no workers, it signs here.
+        _init_worker(private_key_str, family_version, jar)
+        if workers > 0:
+            self._pool = multiprocessing.Pool(
+                workers, _init_worker, (private_key_str, family_version, jar))
+        else:
+            self._pool = None
+
+    @classmethod
+    def from_key_file(cls, key_file, **kwargs):
+        '''Create a pipeline signing with the private key in key_file.'''
+        return cls(read_private_key(key_file), **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, trace):
+        self.close()
+
+    def close(self):
+        '''Stop the worker processes.'''
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def sign(self, operations):
+        '''Yield signed Batches for an iterable of operations, in order.
+
+           At most IN_FLIGHT_PER_WORKER batches per worker are queued at a
+           time, so operations may be a large or endless generator.
+        '''
+        operations = iter(operations)
+        in_flight = collections.deque()
+        max_in_flight = max(self._workers, 1) * IN_FLIGHT_PER_WORKER
+        while True:
+            chunk = [(tuple(operation), self._nonce_source())
+                     for operation in itertools.islice(
+                         operations, self._transactions_per_batch)]
+            if chunk:
+                if self._pool is None:
+                    yield Batch.FromString(_sign_batch(chunk))
+                    continue
+                in_flight.append(self._pool.apply_async(_sign_batch,
+                                                        (chunk,)))
+                if len(in_flight) < max_in_flight:
+                    continue
+            if not in_flight:
+                return
+            yield Batch.FromString(in_flight.popleft().get())
+
+    def batch_lists(self, operations,
+                    batches_per_list=MAX_BATCHES_PER_BATCH_LIST,
+                    max_batch_list_bytes=MAX_BATCH_LIST_BYTES):
+        '''Yield BatchLists of signed batches as each one fills up.'''
+        return pack_batch_lists(self.sign(operations), batches_per_list,
+                                max_batch_list_bytes)
+
+    def submit(self, client, operations, wait=None, **kwargs):
+        '''Sign operations and send them through client as they are ready.
+
+           Each BatchList is sent as soon as it is signed; with 'wait',
+           statuses are awaited after everything has been sent.  Returns
+           one result per BatchList, like CookieJarBatchBuilder.submit().
+        '''
+        sent = [(_batch_ids(batch_list), client._send_batch_list(batch_list))
+                for batch_list in self.batch_lists(operations, **kwargs)]
+        return [client._wait_for_batches(batch_ids, wait, result)
+                for batch_ids, result in sent]
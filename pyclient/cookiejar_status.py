@@ -0,0 +1,177 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+BatchStatusTracker resolves the status of many outstanding batches with
+one bulk batch_statuses request per poll, instead of polling each batch.
+'''
+
+import json
+import logging
+import threading
+import time
+
+from concurrent.futures import Future
+
+from cookiejar_client import STATUS_IDS_PER_REQUEST
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MIN_INTERVAL = 0.1
+DEFAULT_MAX_INTERVAL = 5.0
+
+
+def query_batch_statuses(client, batch_ids,
+                         post_threshold=STATUS_IDS_PER_REQUEST):
+    '''Return a dictionary of batch ID to status for batch_ids.
+
+       Uses one GET for up to post_threshold IDs, otherwise one POST of the
+       ID list, so the URL never grows past the REST API's limits.
+    '''
+    if len(batch_ids) <= post_threshold:
+        result = client._send_to_rest_api(
+            "batch_statuses?id={}".format(",".join(batch_ids)))
+    else:
+        result = client._send_to_rest_api(
+            "batch_statuses", json.dumps(batch_ids), 'application/json')
+    return {batch_status['id']: batch_status
+            for batch_status in json.loads(result)['data']}
+
+
+class BatchStatusTracker(object):
+    '''Tracks outstanding batch IDs and polls their statuses in bulk.
+
+    Each call to track() returns a concurrent.futures.Future that resolves
+    to the batch status dictionary reported by the REST API, for example
+    {"id": ..., "status": "COMMITTED", "invalid_transactions": []}, once
+    the batch is no longer PENDING, or with its last status on timeout.
+
+    All outstanding IDs are resolved with one batch_statuses request per
+    poll: a GET for up to post_threshold IDs, otherwise a POST of the ID
+    list.  The poll interval starts at min_interval, doubles up to
+    max_interval while nothing changes, and drops back as batches resolve.
+    '''
+
+    def __init__(self, client, min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL,
+                 post_threshold=STATUS_IDS_PER_REQUEST):
+        '''Initialize the tracker.
+
+           'client' is a CookieJarClient used to reach the REST API.  Pass
+           the tracker to set_status_tracker() of any CookieJarClient or
+           AsyncCookieJarClient to route its status waits through it.
+        '''
+        self._client = client
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._post_threshold = post_threshold
+        # batch ID -> list of (Future, deadline or None)
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='BatchStatusTracker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def track(self, batch_id, callback=None, timeout=None):
+        '''Start tracking batch_id and return a Future for its status.
+
+           'callback', if given, is called with the status dictionary.
+           'timeout' is the number of seconds after which the Future
+           resolves with the batch's last known (PENDING) status.
+        '''
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(lambda done: callback(done.result()))
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            if self._stopped:
+                raise Exception('Batch status tracker is stopped')
+            self._pending.setdefault(batch_id, []).append((future, deadline))
+            self._condition.notify()
+        return future
+
+    def stop(self):
+        '''Stop polling.  Outstanding Futures are cancelled.'''
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+        for waiters in self._pending.values():
+            for future, _ in waiters:
+                future.cancel()
+        self._pending = {}
+
+    def _run(self):
+        interval = self._min_interval
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                batch_ids = list(self._pending)
+
+            try:
+                statuses = query_batch_statuses(self._client, batch_ids,
+                                                self._post_threshold)
+            except Exception as err:
+                LOGGER.warning('Batch status query failed: %s', err)
+                statuses = {}
+
+            if self._resolve(statuses):
+                interval = self._min_interval
+            else:
+                interval = min(interval * 2, self._max_interval)
+
+            with self._condition:
+                if not self._stopped:
+                    self._condition.wait(interval)
+
+    def _resolve(self, statuses):
+        '''Resolve finished and expired waiters.  Returns True if any batch
+           left the PENDING state.
+        '''
+        now = time.time()
+        done = []
+        changed = False
+        with self._condition:
+            for batch_id, waiters in list(self._pending.items()):
+                status = statuses.get(batch_id)
+                if status is not None and status['status'] != 'PENDING':
+                    changed = True
+                    done.extend((future, status) for future, _ in waiters)
+                    del self._pending[batch_id]
+                    continue
+                if status is None:
+                    status = {'id': batch_id, 'status': 'PENDING',
+                              'invalid_transactions': []}
+                expired = [(future, status) for future, deadline in waiters
+                           if deadline is not None and deadline <= now]
+                if expired:
+                    done.extend(expired)
+                    remaining = [(future, deadline)
+                                 for future, deadline in waiters
+                                 if deadline is None or deadline > now]
+                    if remaining:
+                        self._pending[batch_id] = remaining
+                    else:
+                        del self._pending[batch_id]
+
+        # Complete futures outside the lock; callbacks may call track().
+        for future, status in done:
+            if future.set_running_or_notify_cancel():
+                future.set_result(status)
+        return changed
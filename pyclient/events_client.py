@@ -23,8 +23,13 @@
    https://sawtooth.hyperledger.org/docs/core/releases/latest/app_developers_guide/event_subscriptions.html
 '''
 
+import collections
+import json
+import logging
+import os
 import sys
 import traceback
+from sawtooth_sdk.messaging.stream import RECONNECT_EVENT
 from sawtooth_sdk.messaging.stream import Stream
 from sawtooth_sdk.protobuf import events_pb2
 from sawtooth_sdk.protobuf import client_event_pb2
@@ -35,12 +40,91 @@ from sawtooth_sdk.protobuf.validator_pb2 import Message
 #DEFAULT_VALIDATOR_URL = 'tcp://localhost:4004'
 # For Docker access:
 DEFAULT_VALIDATOR_URL = 'tcp://validator:4004'
-# Calculated from the 1st 6 characters of SHA-512("cookiejar"):
+# Calculated from the 1st 6 characters of SHA-512("cookiejar").
+# Every cookie jar address starts with it, including named and sharded jars,
+# so the "a4d219.*" state-delta filter below matches all of them:
 COOKIEJAR_TP_ADDRESS_PREFIX = 'a4d219'
+# Number of recently processed block IDs sent as last_known_block_ids
+# when resubscribing, so the validator can find one even after a fork.
+RECENT_BLOCKS = 10
 
+LOGGER = logging.getLogger(__name__)
 
-def listen_to_events(delta_filters=None):
-    '''Listen to cookiejar state-delta events.'''
+
+def print_events(events):
+    '''Default event handler: print the events of one block.'''
+    print("Received the following events: ----------")
+    for event in events:
+        print(event)
+
+
+def _block_commit(events):
+    '''Return the attributes of the block-commit event, if any.'''
+    for event in events:
+        if event.event_type == "sawtooth/block-commit":
+            return {attribute.key: attribute.value
+                    for attribute in event.attributes}
+    return None
+
+
+def _load_block_ids(state_file):
+    '''Return the recent block IDs saved in state_file, newest first.'''
+    if state_file is None or not os.path.exists(state_file):
+        return []
+    with open(state_file) as state_fd:
+        return json.load(state_fd)['block_ids']
+
+
+def _save_block_ids(state_file, block_ids):
+    '''Atomically replace state_file with the recent block IDs.'''
+    temp_file = state_file + '.tmp'
+    with open(temp_file, 'w') as state_fd:
+        json.dump({'block_ids': list(block_ids)}, state_fd)
+    os.replace(temp_file, state_file)
+
+
+def _subscribe(stream, subscriptions, last_known_block_ids):
+    '''Subscribe, resuming after the newest known block on the chain.'''
+    request = client_event_pb2.ClientEventsSubscribeRequest(
+        subscriptions=subscriptions,
+        last_known_block_ids=last_known_block_ids)
+    msg = stream.send(message_type=Message.CLIENT_EVENTS_SUBSCRIBE_REQUEST,
+                      content=request.SerializeToString()).result()
+    if msg.message_type != Message.CLIENT_EVENTS_SUBSCRIBE_RESPONSE:
+        raise Exception('Unexpected subscribe response {}'.format(
+            msg.message_type))
+
+    # Parse the subscription response
+    response = client_event_pb2.ClientEventsSubscribeResponse()
+    response.ParseFromString(msg.content)
+    if response.status == \
+            client_event_pb2.ClientEventsSubscribeResponse.UNKNOWN_BLOCK:
+        # None of the known blocks are on the validator's chain any more,
+        # so events since then cannot be replayed.
+        LOGGER.warning('Last known blocks %s are unknown to the validator; '
+                       'resuming from the chain head', last_known_block_ids)
+        return _subscribe(stream, subscriptions, [])
+    if response.status != client_event_pb2.ClientEventsSubscribeResponse.OK:
+        raise Exception('Failed to subscribe to events: {}'.format(
+            response.response_message))
+
+
+def listen_to_events(delta_filters=None, handler=print_events,
+                     state_file=None, validator_url=DEFAULT_VALIDATOR_URL,
+                     last_known_block_ids=None):
+    '''Listen to cookiejar state-delta events.
+
+       'handler' is called with the events of each committed block, in
+       chain order.  The IDs of recently handled blocks are kept (and
+       saved in 'state_file', if given, after each block).  When the
+       validator connection drops, or on a restart with the same
+       state_file, the subscription is renewed with those IDs as
+       last_known_block_ids, so the validator replays the blocks missed
+       meanwhile.  Blocks already handled are skipped, so each block
+       reaches the handler once.
+       'last_known_block_ids' (newest first) overrides the IDs in
+       state_file, for handlers that record their own progress.
+    '''
 
     # Subscribe to events
     block_commit_subscription = events_pb2.EventSubscription(
@@ -51,46 +135,72 @@ def listen_to_events(delta_filters=None):
         event_type="cookiejar/bake")
     eat_subscription = events_pb2.EventSubscription(
         event_type="cookiejar/eat")
-    request = client_event_pb2.ClientEventsSubscribeRequest(
-        subscriptions=[block_commit_subscription, state_delta_subscription, 
-        bake_subscription, eat_subscription])
+    subscriptions = [block_commit_subscription, state_delta_subscription,
+                     bake_subscription, eat_subscription]
 
-    # Send the subscription request
-    stream = Stream(DEFAULT_VALIDATOR_URL)
-    msg = stream.send(message_type=Message.CLIENT_EVENTS_SUBSCRIBE_REQUEST,
-                      content=request.SerializeToString()).result()
-    assert msg.message_type == Message.CLIENT_EVENTS_SUBSCRIBE_RESPONSE
+    # Newest first, as sent in last_known_block_ids.
+    if last_known_block_ids is None:
+        last_known_block_ids = _load_block_ids(state_file)
+    recent_blocks = collections.deque(last_known_block_ids,
+                                      maxlen=RECENT_BLOCKS)
+    last_block_num = None
 
-    # Parse the subscription response
-    response = client_event_pb2.ClientEventsSubscribeResponse()
-    response.ParseFromString(msg.content)
-    assert response.status == \
-           client_event_pb2.ClientEventsSubscribeResponse.OK
+    stream = Stream(validator_url)
+    _subscribe(stream, subscriptions, list(recent_blocks))
 
     # Listen for events in an infinite loop
     print("Listening to events.")
-    while True:
-        msg = stream.receive().result()
-        assert msg.message_type == Message.CLIENT_EVENTS
-
-        # Parse the response
-        event_list = events_pb2.EventList()
-        event_list.ParseFromString(msg.content)
-        print("Received the following events: ----------")
-        for event in event_list.events:
-            print(event)
-
-    # Unsubscribe from events
+    try:
+        while True:
+            msg = stream.receive().result()
+            if msg == RECONNECT_EVENT:
+                # Subscriptions do not survive a reconnect.
+                LOGGER.warning('Reconnected; resuming after block %s',
+                               recent_blocks[0] if recent_blocks else None)
+                _subscribe(stream, subscriptions, list(recent_blocks))
+                continue
+            if msg.message_type != Message.CLIENT_EVENTS:
+                continue
+
+            # Parse the response
+            event_list = events_pb2.EventList()
+            event_list.ParseFromString(msg.content)
+            block = _block_commit(event_list.events)
+            if block is not None:
+                block_num = int(block['block_num'])
+                # A replayed block at or below the last one handled is a
+                # duplicate, unless a fork replaced it with another block.
+                if last_block_num is not None and \
+                        block_num <= last_block_num and \
+                        block['block_id'] in recent_blocks:
+                    continue
+                last_block_num = block_num
+            handler(event_list.events)
+            if block is not None:
+                recent_blocks.appendleft(block['block_id'])
+                if state_file is not None:
+                    _save_block_ids(state_file, recent_blocks)
+    finally:
+        _unsubscribe(stream)
+        stream.close()
+
+
+def _unsubscribe(stream):
+    '''Unsubscribe from events, ignoring a closed connection.'''
     request = client_event_pb2.ClientEventsUnsubscribeRequest()
-    msg = stream.send(Message.CLIENT_EVENTS_UNSUBSCRIBE_REQUEST,
-                      request.SerializeToString()).result()
-    assert msg.message_type == Message.CLIENT_EVENTS_UNSUBSCRIBE_RESPONSE
+    try:
+        msg = stream.send(Message.CLIENT_EVENTS_UNSUBSCRIBE_REQUEST,
+                          request.SerializeToString()).result(timeout=5)
+    except Exception as err:
+        LOGGER.warning('Failed to unsubscribe from events: %s', err)
+        return
 
     # Parse the unsubscribe response
     response = client_event_pb2.ClientEventsUnsubscribeResponse()
     response.ParseFromString(msg.content)
-    assert response.status == \
-           client_event_pb2.ClientEventsUnsubscribeResponse.OK
+    if response.status != \
+            client_event_pb2.ClientEventsUnsubscribeResponse.OK:
+        LOGGER.warning('Failed to unsubscribe from events')
 
 
 def main():
@@ -105,6 +215,7 @@ def main():
     try:
         # To listen to all events, pass delta_filters=None :
         #listen_to_events(delta_filters=None)
+        # To resume after a restart, pass state_file='events.state'
         listen_to_events(delta_filters=filters)
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+Offline micro-benchmark harness for CookieJarTransactionHandler.
+
+Replays synthetic transactions through CookieJarTransactionHandler.apply
+with an in-memory Context instead of a validator, and reports the cost per
+action in ns/op along with memory use.
+
+To track the cost per transaction, save a report on a quiet machine with
+--output baseline.json, then rerun with --baseline baseline.json: the run
+fails if any action got more than --max-regression percent slower.
+'''
+
+import argparse
+import gc
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+import traceback
+
+from sawtooth_sdk.protobuf.processor_pb2 import TpProcessRequest
+from sawtooth_sdk.protobuf.state_context_pb2 import TpStateEntry
+from sawtooth_sdk.protobuf.transaction_pb2 import TransactionHeader
+
+from cookiejar_tp import ACTION_CODES
+from cookiejar_tp import CookieJarTransactionHandler
+from cookiejar_tp import FAMILY_NAME
+from cookiejar_tp import PAYLOAD_FORMAT
+from cookiejar_tp import _hash
+from cookiejar_metrics import ProcessorMetrics
+
+DEFAULT_OPERATIONS = 1000000
+DEFAULT_MIX = 'bake=50,eat=40,clear=10'
+# Cookies in every jar before the run, so eats never run out.
+INITIAL_COOKIES = 10 ** 12
+# Distinct synthetic transactions built per action and replayed in a cycle.
+TRANSACTION_POOL_SIZE = 10000
+# Percent slower than the baseline an action may get before --baseline
+# reports a regression.
+DEFAULT_MAX_REGRESSION = 10.0
+
+
+class MockContext(object):
+    '''In-memory stand-in for sawtooth_sdk.processor.context.Context.
+
+    Implements get_state, set_state and add_event over a dictionary, so
+    the handler can be driven without a validator.  Only the number of
+    events and the last one are kept, to keep long runs in bounded memory.
+    '''
+
+    def __init__(self, state=None):
+        self.state = dict(state or {})
+        self.event_count = 0
+        self.last_event = None
+
+    def get_state(self, addresses, timeout=None):
+        '''Return TpStateEntry objects for the addresses that are set.'''
+        return [TpStateEntry(address=address, data=self.state[address])
+                for address in addresses if address in self.state]
+
+    def set_state(self, entries, timeout=None):
+        '''Set address to data for each entry, returning the addresses.'''
+        self.state.update(entries)
+        return list(entries)
+
+    def add_event(self, event_type, attributes=None, data=None,
+                  timeout=None):
+        '''Record an event.'''
+        self.event_count += 1
+        self.last_event = (event_type, attributes, data)
+
+
+def make_transaction(payload, signer_public_key, family_version='1.0'):
+    '''Return a TpProcessRequest like the one the validator sends apply.'''
+    header = TransactionHeader(
+        signer_public_key=signer_public_key,
+        family_name=FAMILY_NAME,
+        family_version=family_version,
+        payload_sha512=_hash(payload))
+    return TpProcessRequest(header=header, payload=payload)
+
+
+def make_payload(action, amount, family_version='1.0'):
+    '''Return the payload for one action in the given family version.'''
+    if family_version == '1.0':
+        return ",".join([action, str(amount)]).encode()
+    codes = {value: key for key, value in ACTION_CODES.items()}
+    return PAYLOAD_FORMAT.pack(codes[action], amount)
+
+
+def _parse_mix(mix):
+    '''Parse "bake=50,eat=40" into a list of (action, weight).'''
+    weights = []
+    for item in mix.split(','):
+        action, _, weight = item.partition('=')
+        weights.append((action, float(weight or 1)))
+    return weights
+
+
+def _public_keys(count):
+    # apply only hashes the key, so any 66 hex digit string will do.
+    return ['02' + _hash(str(index).encode())[0:64]
+            for index in range(count)]
+
+
+def _initial_state(handler, public_keys, family_version):
+    '''Return a state in which every key's cookie jar is well filled.'''
+    context = MockContext()
+    for public_key in public_keys:
+        handler.apply(make_transaction(
+            make_payload('bake', INITIAL_COOKIES, family_version),
+            public_key, family_version), context)
+    return context.state
+
+
+def _transactions(action, count, public_keys, family_version, seed):
+    rand = random.Random(seed)
+    return [make_transaction(
+        make_payload(action, rand.randint(1, 9), family_version),
+        rand.choice(public_keys), family_version)
+            for _ in range(count)]
+
+
+def bench_action(handler, action, operations, public_keys,
+                 family_version='1.0', seed=0):
+    '''Time 'operations' applies of one action.
+
+       A pool of up to TRANSACTION_POOL_SIZE transactions is built before
+       timing starts and replayed, so only apply (and the mock context) is
+       measured and millions of operations fit in memory.
+       Returns the elapsed seconds.
+    '''
+    pool = _transactions(action, min(operations, TRANSACTION_POOL_SIZE),
+                         public_keys, family_version, seed)
+    transactions = itertools.islice(itertools.cycle(pool), operations)
+    context = MockContext(_initial_state(handler, public_keys,
+                                         family_version))
+    apply = handler.apply
+
+    gc.collect()
+    start = time.perf_counter()
+    for transaction in transactions:
+        apply(transaction, context)
+    return time.perf_counter() - start
+
+
+def trace_action(handler, action, operations, public_keys,
+                 family_version='1.0', seed=0):
+    '''Replay one action under tracemalloc and report memory use.
+
+       Returns the peak traced bytes during the replay and the bytes and
+       blocks still allocated afterwards, per operation.
+    '''
+    context = MockContext(_initial_state(handler, public_keys,
+                                         family_version))
+    transactions = _transactions(action, operations, public_keys,
+                                 family_version, seed)
+    apply = handler.apply
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for transaction in transactions:
+        apply(transaction, context)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    retained_bytes = sum(stat.size_diff for stat in stats)
+    retained_blocks = sum(stat.count_diff for stat in stats)
+    return {
+        'peak_bytes': peak,
+        'retained_bytes_per_op': retained_bytes / operations,
+        'retained_blocks_per_op': retained_blocks / operations,
+    }
+
+
+def run(operations, mix, keys, trace_operations, family_version='1.0',
+        seed=0, metrics=False):
+    '''Benchmark every action in the mix and return a report dictionary.
+
+       With 'metrics', the handler is instrumented, to measure the cost of
+       instrumentation, and the report includes the metrics snapshot.
+    '''
+    namespace = _hash(FAMILY_NAME.encode('utf-8'))[0:6]
+    processor_metrics = ProcessorMetrics() if metrics else None
+    handler = CookieJarTransactionHandler(namespace, processor_metrics)
+    public_keys = _public_keys(keys)
+    total_weight = sum(weight for _, weight in mix)
+
+    report = {'operations': operations, 'keys': keys,
+              'family_version': family_version, 'actions': {}}
+    for action, weight in mix:
+        count = max(1, int(operations * weight / total_weight))
+        elapsed = bench_action(handler, action, count, public_keys,
+                               family_version, seed)
+        result = {
+            'operations': count,
+            'seconds': elapsed,
+            'ns_per_op': elapsed * 1e9 / count,
+            'ops_per_second': count / elapsed if elapsed > 0 else None,
+        }
+        if trace_operations:
+            result.update(trace_action(handler, action,
+                                       min(count, trace_operations),
+                                       public_keys, family_version, seed))
+        report['actions'][action] = result
+
+    if processor_metrics is not None:
+        report['metrics'] = processor_metrics.snapshot()
+    # ru_maxrss is in kilobytes on Linux.
+    report['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return report
+
+
+def compare(report, baseline, max_regression=DEFAULT_MAX_REGRESSION):
+    '''Compare a report's ns/op per action with a baseline report's.
+
+       Returns a dictionary of action to its baseline ns/op, current ns/op
+       and percent change, with 'regression' set where the change exceeds
+       max_regression percent.  Actions missing from either report are
+       skipped.
+    '''
+    comparison = {}
+    for action, result in report['actions'].items():
+        base = baseline.get('actions', {}).get(action)
+        if base is None:
+            continue
+        change = (result['ns_per_op'] - base['ns_per_op']) * 100.0 \
+            / base['ns_per_op']
+        comparison[action] = {
+            'baseline_ns_per_op': base['ns_per_op'],
+            'ns_per_op': result['ns_per_op'],
+            'change_percent': change,
+            'regression': change > max_regression,
+        }
+    return comparison
+
+
+def create_parser(prog_name):
+    '''Create the command line argument parser for the benchmark.'''
+    parser = argparse.ArgumentParser(
+        prog=prog_name,
+        description='Benchmarks CookieJarTransactionHandler.apply offline')
+    parser.add_argument('--operations', type=int, default=DEFAULT_OPERATIONS,
+                        help='transactions to replay (default %(default)s)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weighted action mix (default %(default)s)')
+    parser.add_argument('--keys', type=int, default=100,
+                        help='number of signer keys (cookie jars)')
+    parser.add_argument('--trace-operations', type=int, default=10000,
+                        help='transactions per action to replay under '
+                        'tracemalloc; 0 disables memory tracing')
+    parser.add_argument('--family-version', default='1.1',
+                        choices=['1.0', '1.1'],
+                        help='payload and state encoding to replay')
+    parser.add_argument('--metrics', action='store_true',
+                        help='instrument the handler with ProcessorMetrics')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='log level for the handler while timing')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', help='write the JSON report to a file')
+    parser.add_argument('--baseline',
+                        help='JSON report of an earlier run to compare '
+                        'ns/op with; exits with status 2 on a regression')
+    parser.add_argument('--max-regression', type=float,
+                        default=DEFAULT_MAX_REGRESSION,
+                        help='percent slowdown per action tolerated by '
+                        '--baseline (default %(default)s)')
+    return parser
+
+
+def main(prog_name=os.path.basename(sys.argv[0]), args=None):
+    '''Entry-point function for the handler benchmark.'''
+    try:
+        if args is None:
+            args = sys.argv[1:]
+        args = create_parser(prog_name).parse_args(args)
+        logging.basicConfig()
+        logging.getLogger().setLevel(args.log_level)
+
+        report = run(args.operations, _parse_mix(args.mix), args.keys,
+                     args.trace_operations, args.family_version, args.seed,
+                     args.metrics)
+        if args.baseline:
+            with open(args.baseline) as baseline_fd:
+                report['baseline'] = compare(report, json.load(baseline_fd),
+                                             args.max_regression)
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as output_fd:
+                output_fd.write(output + '\n')
+        print(output)
+        if any(result['regression']
+               for result in report.get('baseline', {}).values()):
+            sys.exit(2)
+    except KeyboardInterrupt:
+        pass
+    except SystemExit as err:
+        raise err
+    except BaseException as err:
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
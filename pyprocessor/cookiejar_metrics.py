@@ -0,0 +1,273 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+'''
+Metrics for the cookiejar transaction processor: counters, latency
+histograms and apply-duration percentiles, available as an in-process
+snapshot and in the Prometheus text format over HTTP.
+'''
+
+import bisect
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+# Upper bounds, in seconds, of the state access latency buckets.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+QUANTILES = (0.5, 0.9, 0.99)
+# Apply durations kept for the percentiles, sampled uniformly.
+RESERVOIR_SIZE = 4096
+
+
+class Counter(object):
+    '''A monotonically increasing count per label value.'''
+
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self._lock:
+            self._values[label_value] = \
+                self._values.get(label_value, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} counter'.format(self.name)]
+        for label_value, value in sorted(self.snapshot().items()):
+            lines.append('{}{{{}="{}"}} {}'.format(
+                self.name, self.label, _escape_label(label_value), value))
+        return lines
+
+
+class Histogram(object):
+    '''Counts of observations in cumulative latency buckets.'''
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self._buckets = buckets
+        # One more than the buckets, for observations above them all.
+        self._counts = [0] * (len(buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += value
+
+    def snapshot(self):
+        with self._lock:
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(self._buckets, self._counts):
+                cumulative += count
+                buckets.append((bound, cumulative))
+            return {'buckets': buckets, 'count': self._count,
+                    'sum': self._sum}
+
+    def render(self):
+        snapshot = self.snapshot()
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} histogram'.format(self.name)]
+        for bound, count in snapshot['buckets']:
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound,
+                                                          count))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name,
+                                                        snapshot['count']))
+        lines.append('{}_sum {}'.format(self.name, snapshot['sum']))
+        lines.append('{}_count {}'.format(self.name, snapshot['count']))
+        return lines
+
+
+class Summary(object):
+    '''Quantiles of observations, from a fixed-size uniform sample.
+
+    Uses reservoir sampling, so memory stays bounded however many
+    observations are made.
+    '''
+
+    def __init__(self, name, help_text, size=RESERVOIR_SIZE,
+                 quantiles=QUANTILES):
+        self.name = name
+        self.help_text = help_text
+        self._size = size
+        self._quantiles = quantiles
+        self._sample = []
+        self._count = 0
+        self._sum = 0.0
+        self._random = random.Random()
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._count += 1
+            self._sum += value
+            if len(self._sample) < self._size:
+                self._sample.append(value)
+            else:
+                index = self._random.randrange(self._count)
+                if index < self._size:
+                    self._sample[index] = value
+
+    def snapshot(self):
+        with self._lock:
+            sample = sorted(self._sample)
+            count, total = self._count, self._sum
+        quantiles = {}
+        for quantile in self._quantiles:
+            quantiles[quantile] = sample[min(int(quantile * len(sample)),
+                                             len(sample) - 1)] \
+                if sample else None
+        return {'quantiles': quantiles, 'count': count, 'sum': total}
+
+    def render(self):
+        snapshot = self.snapshot()
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} summary'.format(self.name)]
+        for quantile, value in sorted(snapshot['quantiles'].items()):
+            if value is not None:
+                lines.append('{}{{quantile="{}"}} {}'.format(
+                    self.name, quantile, value))
+        lines.append('{}_sum {}'.format(self.name, snapshot['sum']))
+        lines.append('{}_count {}'.format(self.name, snapshot['count']))
+        return lines
+
+
+class ProcessorMetrics(object):
+    '''The metrics recorded by CookieJarTransactionHandler.
+
+    Pass an instance as the handler's 'metrics' to enable them.
+    '''
+
+    def __init__(self):
+        self.actions = Counter(
+            'cookiejar_actions_total',
+            'Cookie jar operations applied, by action.', 'action')
+        self.transactions = Counter(
+            'cookiejar_transactions_total',
+            'Transactions applied, by result.', 'result')
+        self.get_state_seconds = Histogram(
+            'cookiejar_get_state_seconds',
+            'Latency of context.get_state calls.')
+        self.set_state_seconds = Histogram(
+            'cookiejar_set_state_seconds',
+            'Latency of context.set_state calls.')
+        self.apply_seconds = Summary(
+            'cookiejar_apply_duration_seconds',
+            'Duration of CookieJarTransactionHandler.apply.')
+        self._metrics = [self.actions, self.transactions,
+                         self.get_state_seconds, self.set_state_seconds,
+                         self.apply_seconds]
+
+    def snapshot(self):
+        '''Return every metric's current value as a dictionary.'''
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def render(self):
+        '''Return every metric in the Prometheus text exposition format.'''
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsContext(object):
+    '''Wraps a transaction Context to time get_state and set_state.'''
+
+    def __init__(self, context, metrics):
+        self._context = context
+        self._metrics = metrics
+
+    def get_state(self, addresses, timeout=None):
+        start = time.perf_counter()
+        try:
+            return self._context.get_state(addresses, timeout)
+        finally:
+            self._metrics.get_state_seconds.observe(
+                time.perf_counter() - start)
+
+    def set_state(self, entries, timeout=None):
+        start = time.perf_counter()
+        try:
+            return self._context.set_state(entries, timeout)
+        finally:
+            self._metrics.set_state_seconds.observe(
+                time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        # add_event, delete_state and the rest pass straight through.
+        return getattr(self._context, name)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(metrics, port, host='127.0.0.1'):
+    '''Serve metrics on host:port in a daemon thread.
+
+       GET /metrics returns the Prometheus text format and
+       GET /metrics.json the snapshot.  Returns the server; call its
+       shutdown() to stop it.
+    '''
+    class _Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = metrics.render().encode()
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body = json.dumps(metrics.snapshot()).encode()
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = _ThreadingHTTPServer((host, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='MetricsServer')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _escape_label(value):
+    '''Escape a label value for the Prometheus text format.'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
@@ -16,39 +16,170 @@
 CookieJarTransactionHandler class interfaces for cookiejar Transaction Family.
 '''
 
+import argparse
+import collections
+import functools
 import traceback
 import sys
 import hashlib
 import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import struct
+import time
 
 from sawtooth_sdk.processor.handler import TransactionHandler
 from sawtooth_sdk.processor.exceptions import InvalidTransaction
 from sawtooth_sdk.processor.exceptions import InternalError
 from sawtooth_sdk.processor.core import TransactionProcessor
 
-# hard-coded for simplicity (otherwise get the URL from the args in main):
-#DEFAULT_URL = 'tcp://localhost:4004'
-# For Docker:
+from cookiejar_metrics import MetricsContext
+from cookiejar_metrics import ProcessorMetrics
+from cookiejar_metrics import start_http_server
+
+# The default for --url.  Outside Docker use tcp://localhost:4004.
 DEFAULT_URL = 'tcp://validator:4004'
 
+# Seconds a worker may take to finish in-flight transactions on shutdown.
+DRAIN_TIMEOUT = 30
+# Seconds before restarting a worker that exited, doubled while it keeps
+# exiting within STABLE_UPTIME seconds of starting.
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+STABLE_UPTIME = 60.0
+# Signer keys (with jar and shard) whose addresses are kept, so a busy
+# jar's address is not rehashed on every transaction.
+ADDRESS_CACHE_SIZE = 4096
+
 LOGGER = logging.getLogger(__name__)
 
 FAMILY_NAME = "cookiejar"
 # TF Prefix is first 6 characters of SHA-512("cookiejar"), a4d219
 
+# Version 1.0 payloads are CSV "action,amount" and state is the count as a
+# decimal ASCII string.  Version 1.1 payloads are one or more fixed 9-byte
+# records, each a 1-byte action code then the amount as an unsigned 64-bit
+# big-endian integer, applied in order as one atomic operation.  Version
+# 1.1 state is a 1-byte format tag then the count in the same form.  The
+# tag is never an ASCII digit, so both state forms can be read.
+# A "shard" record (code 4) makes the records after it apply to the shard
+# of a sharded jar given by its amount field; records before any "shard"
+# record apply to shard 0, the jar's usual address.
+# A "jar" record (code 5) is followed by a UTF-8 jar name whose length in
+# bytes is its amount field, and makes the records after it apply to
+# shard 0 of that named jar.  The empty name is the signer's default jar.
+FAMILY_VERSIONS = ['1.0', '1.1']
+ACTION_CODES = {1: "bake", 2: "eat", 3: "clear", 4: "shard", 5: "jar"}
+# Actions a one-operation payload is applied with directly.
+SINGLE_ACTIONS = frozenset(["bake", "eat", "clear"])
+JAR_CODE = 5
+MAX_SHARDS = 256
+MAX_JAR_NAME_LENGTH = 64
+PAYLOAD_FORMAT = struct.Struct('>BQ')
+STATE_FORMAT = struct.Struct('>BQ')
+STATE_TAG = 1
+# The largest count version 1.1 state can hold, an unsigned 64-bit integer.
+MAX_COUNT = 2 ** 64 - 1
+_STATE_TAG_BYTE = bytes([STATE_TAG])
+
 def _hash(data):
     '''Compute the SHA-512 hash and return the result as hex characters.'''
     return hashlib.sha512(data).hexdigest()
 
-def _get_cookiejar_address(from_key):
+NAMESPACE = _hash(FAMILY_NAME.encode('utf-8'))[0:6]
+
+def _unpack_payload(payload):
+    '''Return (action, amount) from a version 1.0 CSV payload.'''
+    try:
+        action, amount = payload.decode().split(",")
+        amount = int(amount)
+    except ValueError:
+        raise InvalidTransaction('Invalid payload serialization')
+    if amount < 0:
+        raise InvalidTransaction('Amount must not be negative')
+    return action, amount
+
+def _unpack_operations(payload):
+    '''Return a list of (action, amount) from a version 1.1 payload.
+
+       The amount of a "jar" operation is the jar name.
+    '''
+    if not payload:
+        raise InvalidTransaction('Invalid payload serialization')
+    # Without jar records every record is 9 bytes, and the first jar
+    # record would have to start at a multiple of 9 bytes.
+    if JAR_CODE not in payload[::PAYLOAD_FORMAT.size]:
+        if len(payload) % PAYLOAD_FORMAT.size:
+            raise InvalidTransaction('Invalid payload serialization')
+        records = PAYLOAD_FORMAT.iter_unpack(payload)
+    else:
+        records = _iter_records(payload)
+    operations = []
+    for code, amount in records:
+        if code not in ACTION_CODES:
+            raise InvalidTransaction('Unhandled action code {}'.format(code))
+        operations.append((ACTION_CODES[code], amount))
+    return operations
+
+def _iter_records(payload):
+    '''Yield (code, amount) from a payload containing jar records.'''
+    offset = 0
+    while offset < len(payload):
+        if len(payload) - offset < PAYLOAD_FORMAT.size:
+            raise InvalidTransaction('Invalid payload serialization')
+        code, amount = PAYLOAD_FORMAT.unpack_from(payload, offset)
+        offset += PAYLOAD_FORMAT.size
+        if code == JAR_CODE:
+            name = payload[offset:offset + amount]
+            if amount > MAX_JAR_NAME_LENGTH or len(name) < amount:
+                raise InvalidTransaction('Invalid jar name')
+            try:
+                amount = name.decode('utf-8')
+            except UnicodeDecodeError:
+                raise InvalidTransaction('Invalid jar name')
+            if '#' in amount:
+                raise InvalidTransaction('Invalid jar name')
+            offset += len(name)
+        yield code, amount
+
+def _decode_count(data):
+    '''Return the cookie count stored in state data of either version.'''
+    try:
+        if data[0:1] == _STATE_TAG_BYTE:
+            return STATE_FORMAT.unpack(data)[1]
+        return int(data)
+    except (ValueError, struct.error):
+        raise InternalError('Failed to load state data')
+
+def _encode_count(count, family_version):
+    '''Return state data holding count, in the given version's form.'''
+    if family_version == '1.0':
+        return str(count).encode('utf-8')
+    # Version 1.0 state may hold any integer; refuse to write a count
+    # version 1.1 cannot represent rather than fail in struct.pack.
+    if not 0 <= count <= MAX_COUNT:
+        raise InvalidTransaction('Cookie count {} is out of range'
+                                 .format(count))
+    return STATE_FORMAT.pack(STATE_TAG, count)
+
+@functools.lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def _get_cookiejar_address(from_key, shard=0, jar=''):
     '''
     Return the address of a cookiejar object from the cookiejar TF.
 
     The address is the first 6 hex characters from the hash SHA-512(TF name),
     plus the result of the hash SHA-512(cookiejar public key).
+    A named jar hashes the public key followed by "/" and the jar name.
+    Shard 0 of a sharded jar is the jar's usual address; other shards hash
+    the above followed by "#" and the shard number.
     '''
-    return _hash(FAMILY_NAME.encode('utf-8'))[0:6] + \
-                 _hash(from_key.encode('utf-8'))[0:64]
+    if jar:
+        from_key = '{}/{}'.format(from_key, jar)
+    if shard:
+        from_key = '{}#{}'.format(from_key, shard)
+    return NAMESPACE + _hash(from_key.encode('utf-8'))[0:64]
 
 
 class CookieJarTransactionHandler(TransactionHandler):
@@ -58,12 +189,14 @@ class CookieJarTransactionHandler(TransactionHandler):
     This TP communicates with the Validator using the accept/get/set functions.
     This implements functions to "bake" or "eat" cookies in a cookie jar.
     '''
-    def __init__(self, namespace_prefix):
+    def __init__(self, namespace_prefix, metrics=None):
         '''Initialize the transaction handler class.
 
            This is setting the "cookiejar" TF namespace prefix.
+           'metrics', a ProcessorMetrics, enables instrumentation.
         '''
         self._namespace_prefix = namespace_prefix
+        self._metrics = metrics
 
     @property
     def family_name(self):
@@ -72,8 +205,8 @@ class CookieJarTransactionHandler(TransactionHandler):
 
     @property
     def family_versions(self):
-        '''Return Transaction Family version string.'''
-        return ['1.0']
+        '''Return Transaction Family version strings.'''
+        return FAMILY_VERSIONS
 
     @property
     def namespaces(self):
@@ -86,123 +219,463 @@ class CookieJarTransactionHandler(TransactionHandler):
            The apply function does most of the work for this class by
            processing a transaction for the cookiejar transaction family.
         '''
+        metrics = self._metrics
+        if metrics is None:
+            return self._apply(transaction, context)
+
+        start = time.perf_counter()
+        try:
+            self._apply(transaction, MetricsContext(context, metrics))
+        except InvalidTransaction:
+            metrics.transactions.inc('invalid')
+            raise
+        except InternalError:
+            metrics.transactions.inc('internal_error')
+            raise
+        else:
+            metrics.transactions.inc('ok')
+        finally:
+            metrics.apply_seconds.observe(time.perf_counter() - start)
 
+    def _apply(self, transaction, context):
         # Get the payload and extract the cookiejar-specific information.
         # It has already been converted from Base64, but needs deserializing.
-        # It was serialized with CSV: action, value
+        # It was serialized with CSV (version 1.0) or as binary records
+        # (version 1.1), according to the header's family version.
         header = transaction.header
-        payload_list = transaction.payload.decode().split(",")
-        action = payload_list[0]
-        amount = payload_list[1]
+        family_version = header.family_version
 
         # Get the signer's public key, sent in the header from the client.
         from_key = header.signer_public_key
 
+        if family_version != '1.0':
+            operations = _unpack_operations(transaction.payload)
+            LOGGER.debug("Operations = %s.", operations)
+            if self._metrics is not None:
+                for action, _ in operations:
+                    self._metrics.actions.inc(action)
+            self._apply_operations(context, operations, from_key,
+                                   family_version)
+            return
+
+        action, amount = _unpack_payload(transaction.payload)
+        if self._metrics is not None:
+            # The action comes from the payload; keep the label set bounded.
+            self._metrics.actions.inc(
+                action if action in SINGLE_ACTIONS else 'unknown')
+
         # Perform the action.
-        LOGGER.info("Action = %s.", action)
-        LOGGER.info("Amount = %s.", amount)
+        LOGGER.debug("Action = %s, amount = %s.", action, amount)
         if action == "bake":
-            self._make_bake(context, amount, from_key)
+            self._make_bake(context, amount, from_key, family_version)
         elif action == "eat":
-            self._make_eat(context, amount, from_key)
+            self._make_eat(context, amount, from_key, family_version)
         elif action == "clear":
-            self._empty_cookie_jar(context, amount, from_key)
+            self._empty_cookie_jar(context, amount, from_key, family_version)
         else:
             LOGGER.info("Unhandled action. Action should be bake or eat")
 
     @classmethod
-    def _make_bake(cls, context, amount, from_key):
+    def _apply_operations(cls, context, operations, from_key, family_version):
+        '''Apply a list of (action, amount) to the cookie jar in order.
+
+           Every address touched is read once and written once.  If any eat
+           would take more cookies than its shard holds at that point, the
+           transaction is rejected and none of the operations take effect.
+        '''
+        if len(operations) == 1 and operations[0][0] in SINGLE_ACTIONS:
+            action, amount = operations[0]
+            cls._apply_operation(context, action, amount, from_key,
+                                 family_version)
+            return
+
+        # Resolve each operation to the address of its jar and shard.
+        jar = ''
+        shard = 0
+        targets = []
+        for action, amount in operations:
+            if action == "jar":
+                jar, shard = amount, 0
+            elif action == "shard":
+                if amount >= MAX_SHARDS:
+                    raise InvalidTransaction('Invalid shard {}'.format(amount))
+                shard = amount
+            else:
+                targets.append((_get_cookiejar_address(from_key, shard, jar),
+                                action, amount))
+        if not targets:
+            raise InvalidTransaction('No cookie jar operations')
+
+        addresses = list(collections.OrderedDict.fromkeys(
+            address for address, _, _ in targets))
+        state_entries = context.get_state(addresses)
+        counts = {entry.address: _decode_count(entry.data)
+                  for entry in state_entries}
+        existing = set(counts)
+
+        # (action, address) -> total amount baked or eaten
+        totals = collections.OrderedDict()
+        changed = collections.OrderedDict()
+        for address, action, amount in targets:
+            count = counts.get(address, 0)
+            if action == "bake":
+                count += amount
+            elif action == "eat":
+                if count < amount:
+                    raise InvalidTransaction('Not enough cookies to eat. '
+                                             'The number should be <= {}.'
+                                             .format(count))
+                count -= amount
+            else:
+                count = 0
+            if action != "clear":
+                totals[action, address] = \
+                    totals.get((action, address), 0) + amount
+            counts[address] = count
+            # Clearing a jar that does not exist leaves it that way.
+            if action != "clear" or address in existing or address in changed:
+                changed[address] = count
+
+        if not changed:
+            LOGGER.debug('No cookie jar with the key %s.', from_key)
+            return
+
+        addresses = context.set_state(
+            {address: _encode_count(count, family_version)
+             for address, count in changed.items()})
+        if len(addresses) < 1:
+            raise InternalError("State Error")
+
+        # One event per kind of action and jar, with the total amount.
+        for (action, address), total in totals.items():
+            if action == "bake":
+                context.add_event(
+                    event_type="cookiejar/bake",
+                    attributes=[("cookies-baked", str(total)),
+                                ("address", address)])
+            else:
+                context.add_event(
+                    event_type="cookiejar/eat",
+                    attributes=[("cookies-ate", str(total)),
+                                ("address", address)])
+
+    @classmethod
+    def _apply_operation(cls, context, action, amount, from_key,
+                         family_version):
+        '''Apply one bake, eat or clear to the signer's default jar.
+
+           The common single-operation case of _apply_operations, with the
+           same effects, without its per-address bookkeeping.
+        '''
+        address = _get_cookiejar_address(from_key)
+        state_entries = context.get_state([address])
+        if state_entries:
+            count = _decode_count(state_entries[0].data)
+        elif action == "clear":
+            # Clearing a jar that does not exist leaves it that way.
+            LOGGER.debug('No cookie jar with the key %s.', from_key)
+            return
+        else:
+            count = 0
+
+        if action == "bake":
+            count += amount
+        elif action == "eat":
+            if count < amount:
+                raise InvalidTransaction('Not enough cookies to eat. '
+                                         'The number should be <= {}.'
+                                         .format(count))
+            count -= amount
+        else:
+            count = 0
+
+        addresses = context.set_state(
+            {address: _encode_count(count, family_version)})
+        if len(addresses) < 1:
+            raise InternalError("State Error")
+
+        if action == "bake":
+            context.add_event(
+                event_type="cookiejar/bake",
+                attributes=[("cookies-baked", str(amount)),
+                            ("address", address)])
+        elif action == "eat":
+            context.add_event(
+                event_type="cookiejar/eat",
+                attributes=[("cookies-ate", str(amount)),
+                            ("address", address)])
+
+    @classmethod
+    def _make_bake(cls, context, amount, from_key, family_version):
         '''Bake (add) "amount" cookies.'''
         cookiejar_address = _get_cookiejar_address(from_key)
-        LOGGER.info('Got the key %s and the cookiejar address %s.',
-                    from_key, cookiejar_address)
+        LOGGER.debug('Got the key %s and the cookiejar address %s.',
+                     from_key, cookiejar_address)
         state_entries = context.get_state([cookiejar_address])
         new_count = 0
 
         if state_entries == []:
-            LOGGER.info('No previous cookies, creating new cookie jar %s.',
-                        from_key)
-            new_count = int(amount)
+            LOGGER.debug('No previous cookies, creating new cookie jar %s.',
+                         from_key)
+            new_count = amount
         else:
-            try:
-                count = int(state_entries[0].data)
-            except:
-                raise InternalError('Failed to load state data')
-            new_count = int(amount) + int(count)
+            count = _decode_count(state_entries[0].data)
+            new_count = amount + count
 
-        state_data = str(new_count).encode('utf-8')
+        state_data = _encode_count(new_count, family_version)
         addresses = context.set_state({cookiejar_address: state_data})
 
         if len(addresses) < 1:
             raise InternalError("State Error")
         context.add_event(
             event_type="cookiejar/bake",
-            attributes=[("cookies-baked", amount)])
+            attributes=[("cookies-baked", str(amount)),
+                        ("address", cookiejar_address)])
 
     @classmethod
-    def _make_eat(cls, context, amount, from_key):
+    def _make_eat(cls, context, amount, from_key, family_version):
         '''Eat (subtract) "amount" cookies.'''
         cookiejar_address = _get_cookiejar_address(from_key)
-        LOGGER.info('Got the key %s and the cookiejar address %s.',
-                    from_key, cookiejar_address)
+        LOGGER.debug('Got the key %s and the cookiejar address %s.',
+                     from_key, cookiejar_address)
 
         state_entries = context.get_state([cookiejar_address])
-        new_count = 0
-
         if state_entries == []:
-            LOGGER.info('No cookie jar with the key %s.', from_key)
-        else:
-            try:
-                count = int(state_entries[0].data)
-            except:
-                raise InternalError('Failed to load state data')
-            if count < int(amount):
-                raise InvalidTransaction('Not enough cookies to eat. '
-                                         'The number should be <= %s.', count)
-            else:
-                new_count = count - int(amount)
-
-        LOGGER.info('Eating %s cookies out of %d.', amount, count)
-        state_data = str(new_count).encode('utf-8')
-        addresses = context.set_state(
-            {_get_cookiejar_address(from_key): state_data})
+            LOGGER.debug('No cookie jar with the key %s.', from_key)
+            raise InvalidTransaction('No cookie jar to eat from')
+
+        count = _decode_count(state_entries[0].data)
+        if count < amount:
+            raise InvalidTransaction('Not enough cookies to eat. '
+                                     'The number should be <= {}.'
+                                     .format(count))
+        new_count = count - amount
+
+        LOGGER.debug('Eating %s cookies out of %d.', amount, count)
+        state_data = _encode_count(new_count, family_version)
+        addresses = context.set_state({cookiejar_address: state_data})
 
         if len(addresses) < 1:
             raise InternalError("State Error")
         context.add_event(
             event_type="cookiejar/eat",
-            attributes=[("cookies-ate", amount)])
+            attributes=[("cookies-ate", str(amount)),
+                        ("address", cookiejar_address)])
 
     @classmethod
-    def _empty_cookie_jar(cls, context, amount, from_key):
+    def _empty_cookie_jar(cls, context, amount, from_key, family_version):
         cookie_jar_address = _get_cookiejar_address(from_key)
-        LOGGER.info("fetched key %s and state address %s", from_key, cookie_jar_address)
+        LOGGER.debug("fetched key %s and state address %s", from_key,
+                     cookie_jar_address)
         state_entries = context.get_state([cookie_jar_address])
         if state_entries == []:
-            LOGGER.info('No cookie jar with the key %s.', from_key)
+            LOGGER.debug('No cookie jar with the key %s.', from_key)
             return
         else:
-            state_data = str(0).encode('utf-8')
+            state_data = _encode_count(0, family_version)
             addresses = context.set_state(
                 {cookie_jar_address: state_data})
 
         if len(addresses) < 1:
             raise InternalError("State update Error")
-        LOGGER.info("SET global state success")
+        LOGGER.debug("SET global state success")
+
+def _setup_logging(verbose):
+    '''Log at INFO, or at DEBUG (every transaction) with verbose.'''
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG if verbose else logging.INFO)
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+def run_processor(url, metrics=None):
+    '''Register a handler with the validator at url and process
+       transactions until interrupted.
+
+       On SIGTERM or KeyboardInterrupt the processor unregisters, so the
+       validator sends it nothing more, and finishes the transactions it
+       already has before returning.
+    '''
+    # TransactionProcessor.start() drains on KeyboardInterrupt.
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    processor = TransactionProcessor(url=url)
+    handler = CookieJarTransactionHandler(NAMESPACE, metrics)
+    processor.add_handler(handler)
+    processor.start()
+
+def _run_worker(url, metrics_port, metrics_host, verbose):
+    '''Entry point of a worker process started by WorkerSupervisor.'''
+    # Only the supervisor reacts to Ctrl-C; it stops workers with SIGTERM
+    # so each drains exactly once.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _setup_logging(verbose)
+    metrics = None
+    if metrics_port is not None:
+        metrics = ProcessorMetrics()
+        start_http_server(metrics, metrics_port, metrics_host)
+    try:
+        run_processor(url, metrics)
+    except KeyboardInterrupt:
+        pass
+
+class WorkerSupervisor(object):
+    '''Runs several transaction processor processes against one validator.
 
-def main():
+    Each worker registers its own CookieJarTransactionHandler, so the
+    validator can dispatch transactions to all of them in parallel.  A
+    worker that exits is restarted after RESTART_DELAY seconds, backing
+    off up to MAX_RESTART_DELAY while it keeps failing.  On SIGTERM or
+    SIGINT the supervisor stops restarting workers, sends each SIGTERM so
+    it drains, and kills any still running after drain_timeout seconds.
+    With metrics_port, worker i serves its metrics on metrics_port + i.
+    '''
+
+    def __init__(self, workers, url=DEFAULT_URL, metrics_port=None,
+                 metrics_host='127.0.0.1', drain_timeout=DRAIN_TIMEOUT,
+                 verbose=0):
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self._workers = workers
+        self._url = url
+        self._metrics_port = metrics_port
+        self._metrics_host = metrics_host
+        self._drain_timeout = drain_timeout
+        self._verbose = verbose
+        # Per worker slot: the process, its start time, its restart delay
+        # and the time it may be restarted (None while running).
+        self._processes = [None] * workers
+        self._started = [0.0] * workers
+        self._delays = [RESTART_DELAY] * workers
+        self._restart_at = [0.0] * workers
+        self._stopping = False
+
+    def run(self):
+        '''Start the workers and supervise them until signalled.'''
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        try:
+            while not self._stopping:
+                now = time.time()
+                for slot in range(self._workers):
+                    restart_at = self._restart_at[slot]
+                    if restart_at is not None and now >= restart_at:
+                        self._start(slot)
+                self._reap(self._wait())
+        finally:
+            self._drain()
+
+    def stop(self):
+        '''Make run() drain the workers and return.'''
+        self._stopping = True
+
+    def _request_stop(self, signum, frame):
+        LOGGER.info('Received signal %s, stopping workers', signum)
+        self.stop()
+
+    def _start(self, slot):
+        metrics_port = None if self._metrics_port is None \
+            else self._metrics_port + slot
+        process = multiprocessing.Process(
+            target=_run_worker, name='cookiejar-tp-{}'.format(slot),
+            args=(self._url, metrics_port, self._metrics_host,
+                  self._verbose))
+        process.start()
+        LOGGER.info('Started worker %s (pid %s)', slot, process.pid)
+        self._processes[slot] = process
+        self._started[slot] = time.time()
+        self._restart_at[slot] = None
+
+    def _wait(self):
+        '''Wait up to a second for a worker to exit.'''
+        running = [process.sentinel for process in self._processes
+                   if process is not None]
+        if not running:
+            time.sleep(1)
+            return []
+        return multiprocessing.connection.wait(running, timeout=1)
+
+    def _reap(self, sentinels):
+        '''Schedule restarts of the workers that exited.'''
+        if self._stopping:
+            return
+        for slot, process in enumerate(self._processes):
+            if process is None or process.sentinel not in sentinels:
+                continue
+            process.join()
+            uptime = time.time() - self._started[slot]
+            if uptime >= STABLE_UPTIME:
+                self._delays[slot] = RESTART_DELAY
+            delay = self._delays[slot]
+            LOGGER.warning('Worker %s (pid %s) exited with code %s after '
+                           '%.1fs; restarting in %.1fs', slot, process.pid,
+                           process.exitcode, uptime, delay)
+            self._processes[slot] = None
+            self._restart_at[slot] = time.time() + delay
+            self._delays[slot] = min(delay * 2, MAX_RESTART_DELAY)
+
+    def _drain(self):
+        '''Stop every worker, letting each finish in-flight transactions.'''
+        running = [process for process in self._processes
+                   if process is not None and process.is_alive()]
+        for process in running:
+            process.terminate()
+        deadline = time.time() + self._drain_timeout
+        for process in running:
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                LOGGER.warning('Worker pid %s did not drain in %ss; killing '
+                               'it', process.pid, self._drain_timeout)
+                # Process.kill() needs Python 3.7.
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+def create_parser(prog_name):
+    '''Create the command line argument parser for the processor.'''
+    parser = argparse.ArgumentParser(
+        prog=prog_name,
+        description='Runs the cookiejar transaction processor')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='log every transaction at DEBUG level')
+    parser.add_argument('--url', default=DEFAULT_URL,
+                        help='validator URL (default %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processor processes to run, each registered '
+                        'with the validator; more than 1 supervises them and '
+                        'restarts any that exit (default %(default)s)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve metrics on this local HTTP port '
+                        '(/metrics and /metrics.json), plus one port per '
+                        'further worker; off by default')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help='address to serve metrics on '
+                        '(default %(default)s)')
+    return parser
+
+def main(prog_name=os.path.basename(sys.argv[0]), args=None):
     '''Entry-point function for the cookiejar Transaction Processor.'''
     try:
+        if args is None:
+            args = sys.argv[1:]
+        parser = create_parser(prog_name)
+        args = parser.parse_args(args)
+        if args.workers < 1:
+            parser.error('--workers must be at least 1')
+
         # Setup logging for this class.
-        logging.basicConfig()
-        logging.getLogger().setLevel(logging.DEBUG)
+        _setup_logging(args.verbose)
+
+        if args.workers > 1:
+            WorkerSupervisor(args.workers, args.url, args.metrics_port,
+                             args.metrics_host, verbose=args.verbose).run()
+            return
+
+        metrics = None
+        if args.metrics_port is not None:
+            metrics = ProcessorMetrics()
+            start_http_server(metrics, args.metrics_port, args.metrics_host)
 
         # Register the Transaction Handler and start it.
-        processor = TransactionProcessor(url=DEFAULT_URL)
-        sw_namespace = _hash(FAMILY_NAME.encode('utf-8'))[0:6]
-        handler = CookieJarTransactionHandler(sw_namespace)
-        processor.add_handler(handler)
-        processor.start()
+        run_processor(args.url, metrics)
     except KeyboardInterrupt:
         pass
     except SystemExit as err: